@@ -1,9 +1,18 @@
 import numpy as np
-import cv2
 import math
 import gc
-from scipy import interpolate
 
+# bits of an edge's signature, see Edge.findSignature
+FLAT = 1 # the edge is flat
+LEFT_FLAT = 2 # the edge to its left is flat
+RIGHT_FLAT = 4 # the edge to its right is flat
+OUTER = 8 # the tab goes out from the piece, not set for inner edges
+
+'''
+returns a property that reads and writes the row of the edge in the array name of its EdgeTable
+'''
+def tableColumn(name):
+    return property(lambda edge: edge.table.get(name, edge.index), lambda edge, value: edge.table.set(name, edge.index, value))
 
 '''
 The edge class contains information about an edge of a puzzle piece.
@@ -12,22 +21,65 @@ The image is the full image of pieces that the edge is in
 Finds the label, flat, outer, or inner
 Finds the distances from the line between corners on a number of points along the contour, equally spaced
 Finds the colors along the edge.
+
+The metrics are stored in a row (index) of an EdgeTable, which holds the edges of a piece until it is
+added to a PieceCollection, and then all of the edges in the collection. The Edge is just a view of it
 '''
 class Edge:
-    def __init__(self, number, contour, settings):
-        self.points_per_side = settings[2]
+    __slots__ = ('table', 'index', 'number', 'left_neighbor', 'right_neighbor')
+
+    contour = tableColumn('contours') # points equally spaced along the contour
+    distance_arr = tableColumn('distance_arrs') # dist from line btw corners for each point
+    label = tableColumn('labels') # flat, outer, inner
+    corner_dist = tableColumn('corner_dists') # length of line btw corners
+    color_arr = tableColumn('color_arrs') # colors along contour, defined in piece
+    signature = tableColumn('signatures') # which edges it can be compared to, see findSignature
+
+    def __init__(self, number, contour, settings, equidistant_points=None, table=None):
+        # add a row for the edge to the table, a new one if not given
+        self.table = EdgeTable() if table is None else table
+        self.index = self.table.addRows(1)
         self.number = number
         self.corner_dist = np.linalg.norm(contour[0] - contour[-1]) # length of line btw corners
-        self.contour, pts = self.getEquidistantPoints(contour) # space points equally along contour
+        # space points equally along contour, the piece finds them for all of its edges at once
+        if equidistant_points is None:
+            equidistant_points = getEquidistantPoints([contour], settings[2])[0]
+        self.contour, pts = equidistant_points
         self.distance_arr = self.findDistanceArray(contour, pts) # get dist from line btw corners for each pt
         self.label = self.findLabel(self.distance_arr, contour) # flat, outer, inner
-        self.color_arr = None # colors along contour, defined in piece
         self.left_neighbor = None # edge to the left on piece
         self.right_neighbor = None # edge to the right on piece
-        self.color_histograms = None # histograms along the contour edge
-        self.weights = None # used in calculating dists if not stored elsewhere
-        self.mins = None
-        self.maxs = None
+
+    '''
+    makes an Edge for a row of a table that already has its metrics, e.g. loaded from the cache in
+    puzzleCache, without looking at the contour again. Neighbors are set by the piece
+    '''
+    @classmethod
+    def fromTable(cls, number, table, index):
+        edge = cls.__new__(cls)
+        edge.table = table
+        edge.index = index
+        edge.number = number
+        edge.left_neighbor = None
+        edge.right_neighbor = None
+        return edge
+
+    @property
+    def points_per_side(self):
+        return len(self.contour)
+
+    # weights and bounds used in calculating dists if not stored elsewhere, set for the table by setWeights
+    @property
+    def weights(self):
+        return self.table.weights if self.table.get('weighted', self.index) else None
+
+    @property
+    def mins(self):
+        return self.table.mins if self.table.get('weighted', self.index) else None
+
+    @property
+    def maxs(self):
+        return self.table.maxs if self.table.get('weighted', self.index) else None
 
     '''
     compares edges by calculating a score given weights, mins, and maxs using
@@ -57,8 +109,22 @@ class Edge:
     def setRightNeighbor(self, neighbor):
         self.right_neighbor = neighbor
 
-    def setColorHistogram(self, hist):
-        self.color_histogram = hist
+    '''
+    finds the signature of the edge from its label and the labels of its neighbors, so set by the
+    piece once the neighbors are. If two edges can be compared only depends on their signatures,
+    see SIGNATURE_MATCHES
+    '''
+    def findSignature(self):
+        signature = 0
+        if self.label == 'flat':
+            signature |= FLAT
+        elif self.label == 'outer':
+            signature |= OUTER
+        if self.left_neighbor.label == 'flat':
+            signature |= LEFT_FLAT
+        if self.right_neighbor.label == 'flat':
+            signature |= RIGHT_FLAT
+        self.signature = signature
 
     '''
     compares self to other_edge, using the four metrics stored in each edge
@@ -69,33 +135,45 @@ class Edge:
         # if not a valid edge combo, return None
         if other_edge == self:
             return None
-        if self.label == 'flat' or other_edge.label == 'flat':
-            return None
-        if (self.left_neighbor.label == 'flat') != (other_edge.right_neighbor.label == 'flat'):
-            return None
-        if (self.right_neighbor.label == 'flat') != (other_edge.left_neighbor.label == 'flat'):
+        if not SIGNATURE_MATCHES.item(self.signature, other_edge.signature):
             return None
         
         # mirror and invert metrics so that they are compared properly
         dist_arr_1 = -self.distance_arr
         dist_arr_2 = np.flip(other_edge.distance_arr)
         color_arr_2 = np.flip(other_edge.color_arr, axis=0)
-        color_hists_2 = np.flip(other_edge.color_hists, axis=0)
         # l2 norm of difference of dist arrays
         dist_diff = math.sqrt(np.sum((dist_arr_1 - dist_arr_2)**2))
         # l2 norm of color differences
         color_diff = np.sum(math.sqrt(np.sum((self.color_arr - color_arr_2)**2)))
         # l2 norm of color histogram correlations
-        color_diff_2 = 0
-        for i, hist1 in enumerate(self.color_hists):
-            hist2 = color_hists_2[i]
-            color_diff_2 += (1 - cv2.compareHist(hist1, hist2, cv2.HISTCMP_CORREL))**2
-        color_diff_2 = math.sqrt(color_diff_2)
+        vectors1, offsets1, variances1 = self.getHistVectors()
+        vectors2, offsets2, variances2 = other_edge.getHistVectors()
+        dots = np.sum(vectors1 * np.flip(vectors2, axis=0), axis=1, dtype=np.float64)
+        correls = getHistCorrelations(dots, offsets1, np.flip(offsets2), variances1, np.flip(variances2))
+        color_diff_2 = math.sqrt(np.sum((1 - correls)**2))
         # difference in length btw corners
         corner_dist_diff = abs(self.corner_dist - other_edge.corner_dist)
         corner_dist_ratio = max(self.corner_dist, other_edge.corner_dist) / min(self.corner_dist, other_edge.corner_dist)
         return dist_diff, color_diff, color_diff_2, corner_dist_ratio
 
+    '''
+    sets the color histograms along the edge, defined in piece. Only the normalized vectors are kept,
+    see normalizeHists
+    '''
+    def setColorHists(self, hists):
+        vectors, offsets, variances = normalizeHists(hists)
+        self.table.set('hist_vectors', self.index, vectors)
+        self.table.set('hist_offsets', self.index, offsets)
+        self.table.set('hist_variances', self.index, variances)
+
+    '''
+    returns the color histograms as normalized vectors, see normalizeHists
+    '''
+    def getHistVectors(self):
+        return self.table.get('hist_vectors', self.index), self.table.get('hist_offsets', self.index), \
+                self.table.get('hist_variances', self.index)
+
     '''
     calculates the distance to the line between corners
     for each of the num_points points along the contour
@@ -140,36 +218,219 @@ class Edge:
             label = 'inner'
         return label
 
+'''
+The EdgeTable class holds the metrics of a set of edges in numpy arrays, with a row for each edge,
+so the edges of a whole collection are stored together and can be used as arrays by EdgeMatrix.
+Each array is made when it is first set, with the shape and type of the value, and grows with the
+number of edges
+'''
+class EdgeTable:
+    def __init__(self):
+        self.num_edges = 0
+        self.capacity = 0 # number of rows in the arrays, some may not be used yet
+        self.arrays = {} # name of the metric -> array
+        # weights and bounds used by Edge.compareWeighted, for the edges set by setWeights
+        self.weights = None
+        self.mins = None
+        self.maxs = None
+
+    '''
+    makes a table from arrays with a row for each edge, e.g. loaded from the cache in puzzleCache
+    '''
+    @classmethod
+    def fromArrays(cls, arrays):
+        table = cls()
+        for name, array in arrays.items():
+            table.arrays[name] = array
+            table.num_edges = table.capacity = len(array)
+        return table
+
+    '''
+    returns the arrays of the table, without the unused rows
+    '''
+    def getArrays(self):
+        return {name: self.getArray(name) for name in self.arrays}
+
+    '''
+    adds num_edges empty rows, returns the index of the first one
+    '''
+    def addRows(self, num_edges):
+        first = self.num_edges
+        self.num_edges += num_edges
+        if self.num_edges > self.capacity:
+            self.capacity = max(self.num_edges, self.capacity * 3 // 2)
+            for name, array in self.arrays.items():
+                new_array = np.zeros((self.capacity,) + array.shape[1:], dtype=array.dtype)
+                new_array[:first] = array[:first]
+                self.arrays[name] = new_array
+        return first
 
     '''
-    finds equally spaced points along the contour
+    returns the value of the row index in the array name, or None if it isn't set
     '''
-    def getEquidistantPoints(self, contour):
-        # length from beginnning to each point
-        dists = [cv2.arcLength(contour[:i], False) for i in range(len(contour))]
+    def get(self, name, index):
+        array = self.arrays.get(name)
+        if array is None:
+            return None
+        return array[index]
+
+    '''
+    sets the row index of the array name to value, making the array if it doesn't exist yet
+    '''
+    def set(self, name, index, value):
+        if not name in self.arrays:
+            array = np.asarray(value)
+            self.addArray(name, array.shape, object if array.dtype.kind == 'U' else array.dtype)
+        self.arrays[name][index] = value
+
+    '''
+    makes an empty array with rows of the given shape
+    '''
+    def addArray(self, name, shape, dtype):
+        self.arrays[name] = np.zeros((self.capacity,) + tuple(shape), dtype=dtype)
+
+    '''
+    returns the rows for the edges at indices of the array name, all of the edges if None.
+    Consecutive indices are a view of the array, others are a copy
+    '''
+    def getArray(self, name, indices=None):
+        array = self.arrays[name]
+        if indices is None:
+            return array[:self.num_edges]
+        indices = np.asarray(indices, dtype=int)
+        if len(indices) > 0 and np.array_equal(indices, np.arange(indices[0], indices[0] + len(indices))):
+            return array[indices[0]:indices[0] + len(indices)]
+        return array[indices]
+
+    '''
+    copies the rows of the edges, which can be in other tables, to the end of this table and makes
+    the edges views of the new rows
+    '''
+    def takeEdges(self, edges):
+        first = self.addRows(len(edges))
+        for table, positions in groupByTable(edges).items():
+            rows = [edges[k].index for k in positions]
+            for name, array in table.arrays.items():
+                if not name in self.arrays:
+                    self.addArray(name, array.shape[1:], array.dtype)
+                self.arrays[name][first + np.array(positions)] = array[rows]
+        for k, edge in enumerate(edges):
+            edge.table = self
+            edge.index = first + k
+
+    '''
+    sets the weights and bounds used by Edge.compareWeighted for the edges at indices
+    '''
+    def setWeights(self, indices, weights, mins, maxs):
+        self.weights = list(weights)
+        self.mins = list(mins)
+        self.maxs = list(maxs)
+        if not 'weighted' in self.arrays:
+            self.addArray('weighted', (), bool)
+        self.arrays['weighted'][indices] = True
+
+'''
+finds which pairs of edge signatures can be compared. Flat edges can't be, and the flat edges next
+to the two edges have to line up: the left of one with the right of the other. Which way the tabs
+go isn't checked
+'''
+def getSignatureMatches():
+    signatures = np.arange(16)
+    signatures1, signatures2 = signatures[:,np.newaxis], signatures[np.newaxis,:]
+    matches = (signatures1 & FLAT == 0) & (signatures2 & FLAT == 0)
+    matches &= (signatures1 & LEFT_FLAT == 0) == (signatures2 & RIGHT_FLAT == 0)
+    matches &= (signatures1 & RIGHT_FLAT == 0) == (signatures2 & LEFT_FLAT == 0)
+    return matches
+
+# if the edges with each pair of signatures can be compared, indexed by both signatures
+SIGNATURE_MATCHES = getSignatureMatches()
+
+'''
+returns the positions in edges of the edges in each table, as a dict of table to positions
+'''
+def groupByTable(edges):
+    groups = {}
+    for k, edge in enumerate(edges):
+        groups.setdefault(edge.table, []).append(k)
+    return groups
+
+'''
+returns a table with the rows of the edges and their indices in it. If the edges are all in one
+table it is returned, otherwise their rows are copied to a new one
+'''
+def getTableRows(edges):
+    tables = groupByTable(edges)
+    if len(tables) == 1:
+        return edges[0].table, np.array([edge.index for edge in edges], dtype=int)
+    table = EdgeTable()
+    first = table.addRows(len(edges))
+    for source, positions in tables.items():
+        rows = [edges[k].index for k in positions]
+        for name, array in source.arrays.items():
+            if not name in table.arrays:
+                table.addArray(name, array.shape[1:], array.dtype)
+            table.arrays[name][first + np.array(positions)] = array[rows]
+    return table, np.arange(len(edges))
+
+'''
+finds num_points equally spaced points along each of the contours
+returns the new contour and the position of each point in the old contour, for each contour
+'''
+def getEquidistantPoints(contours, num_points):
+    # length of each segment, for all of the contours at once. cv2.arcLength finds these
+    # in float32 and adds them up as doubles, so they are found the same way here
+    points = np.concatenate(contours)[:,0].astype(np.float32)
+    deltas = points[1:] - points[:-1]
+    segment_lengths = np.sqrt(deltas[:,0]*deltas[:,0] + deltas[:,1]*deltas[:,1]).astype(np.float64)
+
+    equidistant_points = []
+    start = 0
+    for contour in contours:
+        num_contour_points = len(contour)
+        # length from beginning to each point, the same as cv2.arcLength(contour[:i], False) for each i
+        lengths = np.concatenate(([0, 0], segment_lengths[start:start + num_contour_points - 2]))[:num_contour_points]
+        dists = np.cumsum(lengths)
+        start += num_contour_points
         total_len = dists[-1]
         # desired distance from init point in contour, equally spaced
-        desired_distances = np.linspace(0, total_len, num=self.points_per_side)
-
-        # interpolate >:(
-
-        interp = interpolate.interp1d(dists, range(len(contour)), kind="linear")
-        pts = interp(desired_distances).astype(int)
-
-        interp_cont_x = interpolate.interp1d(dists, contour[:,0,0], kind="linear")
-        interp_cont_y = interpolate.interp1d(dists, contour[:,0,1], kind="linear")
-
-        new_x = interp_cont_x(desired_distances)
-        new_y = interp_cont_y(desired_distances)
-        new_contour = None
-        prev_point = None
-        for i, x in enumerate(new_x):
-            y = new_y[i]
-            if new_contour is None:
-                new_contour = np.array([[x, y]])
-            else:
-                new_contour = np.concatenate((new_contour, [[x, y]]))
-        new_contour = new_contour[:,np.newaxis,:].astype(int)
-        contour = np.unique(contour, axis=1)
-        self.points_per_side = len(pts)
-        return new_contour, pts
\ No newline at end of file
+        desired_distances = np.linspace(0, total_len, num=num_points)
+
+        pts = np.interp(desired_distances, dists, np.arange(num_contour_points)).astype(int)
+        new_x = np.interp(desired_distances, dists, contour[:,0,0])
+        new_y = np.interp(desired_distances, dists, contour[:,0,1])
+        new_contour = np.stack((new_x, new_y), axis=1)[:,np.newaxis,:].astype(int)
+        equidistant_points.append((new_contour, pts))
+    return equidistant_points
+
+'''
+turns a list of color histograms into vectors so that the correlation btw two histograms is
+a dot product, the same value as cv2.compareHist(hist1, hist2, cv2.HISTCMP_CORREL)
+returns the mean-centered vectors scaled to length 1 (float32), and an offset and variance for
+each histogram, used by getHistCorrelations
+'''
+def normalizeHists(hists):
+    hists = np.asarray(hists, dtype=np.float32)
+    hist_shape = hists.shape[1:]
+    hists = hists.reshape(len(hists), -1).astype(np.float64)
+    num_bins = hists.shape[1]
+    # cv2 reads a 3d histogram as a 2d image with many channels, so it takes the mean over
+    # rows * cols elements instead of over every bin. The difference is kept in the offsets
+    total = hist_shape[0] * hist_shape[1] if len(hist_shape) > 1 else hist_shape[0]
+    sums = np.sum(hists, axis=1)
+    variances = np.sum(hists**2, axis=1) - sums**2 / total
+    scales = np.sqrt(np.abs(variances))
+    scales[scales == 0] = 1
+    vectors = (hists - sums[:,np.newaxis] / num_bins) / scales[:,np.newaxis]
+    offsets = sums * math.sqrt(max(1 / total - 1 / num_bins, 0)) / scales
+    return vectors.astype(np.float32), offsets, variances
+
+'''
+finds the correlations btw histograms from the dot products of their vectors from normalizeHists,
+along with their offsets and variances. Works on single values or arrays of them
+'''
+def getHistCorrelations(dots, offsets1, offsets2, variances1, variances2):
+    correls = dots - offsets1 * offsets2
+    denom = variances1 * variances2
+    # same as cv2, 1 if either histogram is constant and NaN if the variances have different signs
+    correls = np.where(denom < 0, np.nan, correls)
+    return np.where(np.abs(denom) > np.finfo(np.float64).eps, correls, 1)
@@ -0,0 +1,798 @@
+import numpy as np
+import os
+from collections import OrderedDict
+from functools import partial
+from edge import getHistCorrelations, getTableRows, FLAT, SIGNATURE_MATCHES
+from scipy.spatial import cKDTree
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+# raw comparison scores from Edge.compare, one entry for each valid pair of edges
+METRIC_NAMES = ('dist', 'color', 'color_hist', 'corner')
+RAW_METRICS_DTYPE = np.dtype([('edge1', np.int32), ('edge2', np.int32)] + [(name, np.float32) for name in METRIC_NAMES])
+
+'''
+The EdgeMatrix class stacks the metrics stored in every Edge of a list of pieces into numpy arrays,
+so the four metrics from Edge.compare can be calculated for whole blocks of edge pairs at once
+instead of one pair at a time.
+
+Edges are indexed by their edge id, piece.number * 4 + edge (same as hash2 in puzzleSolver),
+so the pieces must be numbered by their position in the list.
+'''
+class EdgeMatrix:
+    def __init__(self, pieces, block_size=64):
+        edges = [edge for piece in pieces for edge in piece.edges]
+        self.num_edges = len(edges)
+        self.block_size = block_size # number of rows compared at once
+        # rows of the edges in the EdgeTable of the collection
+        table, rows = getTableRows(edges)
+
+        # shape metrics. mirror the other edge so that it lines up with this one
+        self.dist_arrs = np.array(table.getArray('distance_arrs', rows), dtype=np.float64)
+        self.dist_arrs_flipped = -np.flip(self.dist_arrs, axis=1)
+        self.dist_norms = np.sum(self.dist_arrs**2, axis=1)
+
+        # colors along the edge, flattened so they can be compared with a dot product
+        color_arrs = np.array(table.getArray('color_arrs', rows), dtype=np.float64)
+        self.color_arrs = color_arrs.reshape(self.num_edges, -1)
+        self.color_arrs_flipped = np.flip(color_arrs, axis=1).reshape(self.num_edges, -1)
+        self.color_norms = np.sum(self.color_arrs**2, axis=1)
+
+        # color histograms along the edge as normalized vectors, so the correlations for every
+        # pair in a block are one matrix product for each histogram. These are the biggest arrays,
+        # so they are a view of the table instead of a copy when the rows are consecutive
+        self.hist_vectors = table.getArray('hist_vectors', rows)
+        self.hist_offsets = table.getArray('hist_offsets', rows)
+        self.hist_variances = table.getArray('hist_variances', rows)
+
+        self.corner_dists = np.array(table.getArray('corner_dists', rows), dtype=np.float64)
+
+        # info used to find which edge pairs are valid, same rules as Edge.compare
+        self.piece_ids = np.repeat(np.arange(len(pieces)), 4)
+        self.signatures = np.array(table.getArray('signatures', rows), dtype=np.int64)
+        self.flat = self.signatures & FLAT != 0
+
+    '''
+    yields the edge ids for the rows of each block, in order
+    '''
+    def getBlocks(self):
+        for start in range(0, self.num_edges, self.block_size):
+            yield np.arange(start, min(start + self.block_size, self.num_edges))
+
+    '''
+    finds which pairs of edges (rows x cols) can be compared. Only edges on pieces after the
+    piece of the row edge are included, so that each pair is only compared once
+    '''
+    def getValidMask(self, rows, cols):
+        return self.getValidPairs(rows[:,np.newaxis], np.arange(self.num_edges)[np.newaxis,cols])
+
+    '''
+    finds which pairs (edges1[i], edges2[i]) can be compared, same rules as getValidMask
+    '''
+    def getValidPairs(self, edges1, edges2):
+        valid = self.piece_ids[edges2] > self.piece_ids[edges1]
+        valid &= SIGNATURE_MATCHES[self.signatures[edges1], self.signatures[edges2]]
+        return valid
+
+    '''
+    compares the row edges to every edge on a later piece, same as calling Edge.compare on every pair
+    returns the column edge ids, the valid mask and an array for each of the four metrics,
+    shape (len(rows), len(cols))
+    first_col - only compare to edge ids from this one on, used to compare just the new edges
+    '''
+    def compareBlock(self, rows, first_col=0):
+        # edges on pieces before the first row piece are never valid, skip them
+        cols = slice(max((self.piece_ids[rows[0]] + 1) * 4, first_col), self.num_edges)
+        row_block = slice(rows[0], rows[-1] + 1)
+        valid = self.getValidMask(rows, cols)
+
+        # l2 norm of difference of dist arrays, |a - b|^2 = |a|^2 + |b|^2 - 2ab
+        dist_diff = self.dist_norms[rows,np.newaxis] + self.dist_norms[np.newaxis,cols] - \
+                2 * (self.dist_arrs_flipped[rows] @ self.dist_arrs[cols].T)
+        dist_diff = np.sqrt(np.maximum(dist_diff, 0))
+
+        # l2 norm of color differences
+        color_diff = self.color_norms[rows,np.newaxis] + self.color_norms[np.newaxis,cols] - \
+                2 * (self.color_arrs[rows] @ self.color_arrs_flipped[cols].T)
+        color_diff = np.sqrt(np.maximum(color_diff, 0))
+
+        # l2 norm of color histogram correlations, histogram i is compared to the mirrored one
+        # uses the same correlation as cv2.compareHist(HISTCMP_CORREL)
+        num_hists = self.hist_vectors.shape[1]
+        color_diff_hist = np.zeros(valid.shape)
+        for i in range(num_hists):
+            j = num_hists - 1 - i
+            dots = self.hist_vectors[row_block,i] @ self.hist_vectors[cols,j].T
+            correl = getHistCorrelations(dots, self.hist_offsets[row_block,i,np.newaxis], self.hist_offsets[np.newaxis,cols,j],
+                    self.hist_variances[row_block,i,np.newaxis], self.hist_variances[np.newaxis,cols,j])
+            color_diff_hist += (1 - correl)**2
+        color_diff_hist = np.sqrt(color_diff_hist)
+
+        # ratio of the lengths btw corners
+        corners1 = self.corner_dists[rows,np.newaxis]
+        corners2 = self.corner_dists[np.newaxis,cols]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            corner_ratio = np.maximum(corners1, corners2) / np.minimum(corners1, corners2)
+
+        return np.arange(self.num_edges)[cols], valid, dist_diff, color_diff, color_diff_hist, corner_ratio
+
+    '''
+    compares each pair (edges1[i], edges2[i]), same metrics as compareBlock but only for the given pairs
+    '''
+    def comparePairs(self, edges1, edges2):
+        dist_diff = np.sqrt(np.sum((self.dist_arrs_flipped[edges1] - self.dist_arrs[edges2])**2, axis=1))
+        color_diff = np.sqrt(np.sum((self.color_arrs[edges1] - self.color_arrs_flipped[edges2])**2, axis=1))
+
+        num_hists = self.hist_vectors.shape[1]
+        color_diff_hist = np.zeros(len(edges1))
+        for i in range(num_hists):
+            j = num_hists - 1 - i
+            dots = np.einsum('ij,ij->i', self.hist_vectors[edges1,i], self.hist_vectors[edges2,j], dtype=np.float64)
+            correl = getHistCorrelations(dots, self.hist_offsets[edges1,i], self.hist_offsets[edges2,j],
+                    self.hist_variances[edges1,i], self.hist_variances[edges2,j])
+            color_diff_hist += (1 - correl)**2
+        color_diff_hist = np.sqrt(color_diff_hist)
+
+        corners1 = self.corner_dists[edges1]
+        corners2 = self.corner_dists[edges2]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            corner_ratio = np.maximum(corners1, corners2) / np.minimum(corners1, corners2)
+
+        return dist_diff, color_diff, color_diff_hist, corner_ratio
+
+    '''
+    compares the row edges to every edge on a later piece, returns the raw metrics of the valid pairs
+    as an array with RAW_METRICS_DTYPE along with the min and max of each metric in the block
+    '''
+    def getRawMetricsForRows(self, rows, first_col=0):
+        cols, valid, *metrics = self.compareBlock(rows, first_col)
+        row_indices, col_indices = np.nonzero(valid)
+        block = np.empty(len(col_indices), dtype=RAW_METRICS_DTYPE)
+        block['edge1'] = rows[row_indices]
+        block['edge2'] = cols[col_indices]
+        for name, metric in zip(METRIC_NAMES, metrics):
+            block[name] = metric[valid]
+        return block, getBounds(block)
+
+    '''
+    same as getRawMetricsForRows, for the pairs (edges1[i], edges2[i]) which must all be valid
+    '''
+    def getRawMetricsForPairs(self, pairs):
+        edges1, edges2 = pairs
+        block = np.empty(len(edges1), dtype=RAW_METRICS_DTYPE)
+        block['edge1'] = edges1
+        block['edge2'] = edges2
+        for name, metric in zip(METRIC_NAMES, self.comparePairs(edges1, edges2)):
+            block[name] = metric
+        return block, getBounds(block)
+
+    '''
+    finds the pairs of edges worth comparing with all four metrics, for puzzles too big to compare
+    every pair. The dist arrays and corner dists of the edges are put in a KD tree, and each edge
+    keeps the num_candidates edges with the closest shape, mirrored so it lines up with the edge
+    returns the valid pairs as (edges1, edges2), sorted by edges1 then edges2, edges1 on the earlier piece
+    '''
+    def getShapeCandidates(self, num_candidates):
+        searchable = np.nonzero(~self.flat)[0]
+        num_candidates = min(num_candidates, len(searchable))
+        if num_candidates == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        features = np.hstack((self.dist_arrs, self.corner_dists[:,np.newaxis]))
+        queries = np.hstack((self.dist_arrs_flipped, self.corner_dists[:,np.newaxis]))
+        tree = cKDTree(features[searchable])
+        _, found = tree.query(queries[searchable], k=num_candidates)
+        found = searchable[np.reshape(found, (len(searchable), num_candidates))]
+
+        # put the edge on the earlier piece first, same as the full comparison
+        edges1 = np.repeat(searchable, num_candidates)
+        edges2 = found.reshape(-1)
+        pairs = np.unique(np.minimum(edges1, edges2) * self.num_edges + np.maximum(edges1, edges2))
+        edges1, edges2 = pairs // self.num_edges, pairs % self.num_edges
+        valid = self.getValidPairs(edges1, edges2)
+        return edges1[valid], edges2[valid]
+
+    '''
+    compares every valid pair of edges once, returns the raw metrics as an array with
+    RAW_METRICS_DTYPE, sorted by edge1 then edge2, and the min and max of each metric
+    the rows are split into blocks, which are spread over num_workers processes if more than 1
+    candidates - (edges1, edges2) from getShapeCandidates, to only compare those pairs
+    path - if set, the raw metrics are written to this file as they are found and returned as a
+           read only memory map of it, so they don't all have to fit in memory
+    first_new_edge - only compare the pairs with an edge from this edge id on, used when pieces are
+           added after the others were compared. The new pieces must be numbered after the others
+    '''
+    def getRawMetrics(self, progress=None, num_workers=1, candidates=None, path=None, first_new_edge=0):
+        if candidates is None:
+            tasks = [rows for rows in self.getBlocks()]
+            compare = partial(self.getRawMetricsForRows, first_col=first_new_edge)
+            compare_in_worker = partial(compareRowsInWorker, first_col=first_new_edge)
+            task_rows = tasks
+        else:
+            # edge2 is always on the later piece, so it's the new one if either is
+            edges1, edges2 = candidates
+            edges1, edges2 = edges1[edges2 >= first_new_edge], edges2[edges2 >= first_new_edge]
+            chunk_size = self.block_size * 64
+            tasks = [(edges1[i:i + chunk_size], edges2[i:i + chunk_size]) for i in range(0, len(edges1), chunk_size)]
+            compare, compare_in_worker = self.getRawMetricsForPairs, comparePairsInWorker
+            task_rows = [task[0] for task in tasks]
+
+        blocks = []
+        bounds = []
+        out_file = None
+        if not path is None:
+            # remove the old file first, so memory maps of it that are still open aren't truncated
+            if os.path.exists(path):
+                os.remove(path)
+            out_file = open(path, 'wb')
+        def addResult(rows, result):
+            if not progress is None:
+                progress(rows)
+            block, block_bounds = result
+            if out_file is None:
+                blocks.append(block)
+            else:
+                block.tofile(out_file)
+            bounds.append(block_bounds)
+
+        try:
+            if num_workers > 1 and len(tasks) > 1:
+                shared_arrays, spec = shareArrays(self.getArrays())
+                try:
+                    with ProcessPoolExecutor(num_workers, initializer=initMatrixWorker, initargs=(spec,)) as executor:
+                        for rows, result in zip(task_rows, executor.map(compare_in_worker, tasks)):
+                            addResult(rows, result)
+                finally:
+                    freeArrays(shared_arrays)
+            else:
+                for rows, task in zip(task_rows, tasks):
+                    addResult(rows, compare(task))
+        finally:
+            if not out_file is None:
+                out_file.close()
+
+        if not path is None and os.path.getsize(path) > 0:
+            raw_metrics = np.memmap(path, dtype=RAW_METRICS_DTYPE, mode='r')
+        elif len(blocks) > 0:
+            raw_metrics = np.concatenate(blocks)
+        else:
+            raw_metrics = np.empty(0, dtype=RAW_METRICS_DTYPE)
+        return raw_metrics, mergeBounds(bounds)
+
+    '''
+    returns the numpy arrays of the matrix by name, used to share them with other processes
+    '''
+    def getArrays(self):
+        return {name: value for name, value in vars(self).items() if isinstance(value, np.ndarray)}
+
+    '''
+    makes an EdgeMatrix from arrays made by getArrays, without looking at the pieces again
+    '''
+    @classmethod
+    def fromArrays(cls, arrays, block_size=64):
+        edge_matrix = cls.__new__(cls)
+        for name, value in arrays.items():
+            setattr(edge_matrix, name, value)
+        edge_matrix.num_edges = len(edge_matrix.piece_ids)
+        edge_matrix.block_size = block_size
+        return edge_matrix
+
+'''
+The EdgeScores class holds the raw metrics for every valid pair of edges, found once by EdgeMatrix.
+The metrics are min-max normalized and weighted afterwards, so the weights can be changed
+without comparing the edges again.
+complete is False if only some of the pairs were compared (see EdgeMatrix.getShapeCandidates)
+'''
+class EdgeScores:
+    def __init__(self, raw_metrics, num_edges, bounds=None, complete=True):
+        self.raw_metrics = raw_metrics
+        self.num_edges = num_edges
+        self.complete = complete
+        if bounds is None:
+            bounds = getBounds(raw_metrics)
+        if bounds is None:
+            bounds = ([0.0] * len(METRIC_NAMES), [1.0] * len(METRIC_NAMES))
+        self.mins, self.maxs = bounds
+
+    '''
+    returns the weighted sum of the normalized metrics for each pair, in the same order as raw_metrics
+    weights are in the same order as METRIC_NAMES. start and end give a range of the pairs to use
+    '''
+    def getWeightedDists(self, weights, start=0, end=None):
+        raw_metrics = self.raw_metrics[start:end]
+        dists = np.zeros(len(raw_metrics))
+        for weight, name, min_value, max_value in zip(weights, METRIC_NAMES, self.mins, self.maxs):
+            dists += weight * ((raw_metrics[name] - min_value) / (max_value - min_value))
+        return dists
+
+    '''
+    adds the raw metrics of pairs with edges that were added after the others were compared, found
+    with EdgeMatrix.getRawMetrics(first_new_edge=...). They go after the pairs already stored, in the
+    file if the raw metrics are memory mapped, and the bounds are extended to include them
+    returns True if the bounds changed, so the dists of the old pairs changed too
+    '''
+    def addRawMetrics(self, raw_metrics, num_edges, bounds):
+        old_bounds = (self.mins, self.maxs)
+        if len(self.raw_metrics) > 0:
+            bounds = mergeBounds([old_bounds, bounds])
+        if len(raw_metrics) > 0:
+            if isinstance(self.raw_metrics, np.memmap):
+                path = self.raw_metrics.filename
+                with open(path, 'ab') as f:
+                    raw_metrics.tofile(f)
+                self.raw_metrics = np.memmap(path, dtype=RAW_METRICS_DTYPE, mode='r')
+            else:
+                self.raw_metrics = np.concatenate((self.raw_metrics, raw_metrics))
+        self.num_edges = num_edges
+        if bounds is None:
+            return False
+        self.mins, self.maxs = bounds
+        return (self.mins, self.maxs) != old_bounds
+
+'''
+The EdgeDists class stores the weighted distance between pairs of edges in a float32 matrix
+indexed by edge id, piece.number * 4 + edge. Both orders of a pair are stored so lookups are
+a single index. Pairs that haven't been stored hold fill_value, NaN means the dist isn't known.
+
+If path is given the matrix is a memory mapped .npy file instead, for puzzles where it doesn't
+fit in memory. It is written once and then read from the file as it is needed. dtype can be
+float16 to halve the size of the file, at the cost of precision.
+'''
+class EdgeDists:
+    def __init__(self, num_edges, fill_value=float('nan'), path=None, dtype=np.float32):
+        self.num_edges = num_edges
+        self.fill_value = fill_value
+        self.path = path
+        if path is None:
+            self.dists = np.full((num_edges, num_edges), fill_value, dtype=dtype)
+        else:
+            # remove the old file first, so memory maps of it that are still open aren't truncated
+            if os.path.exists(path):
+                os.remove(path)
+            self.dists = self.openFile(path, num_edges, dtype)
+        self.num_stored = 0
+        # DistMemo for dists found as the solver goes, for pairs that aren't stored
+        self.memo = None
+
+    '''
+    makes a new memory mapped .npy file for the matrix filled with fill_value, a chunk of rows at a time
+    '''
+    def openFile(self, path, num_edges, dtype):
+        dists = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(num_edges, num_edges))
+        for start in range(0, num_edges, 1024):
+            dists[start:start + 1024] = self.fill_value
+        return dists
+
+    '''
+    makes room for edges added after the dists were stored, the new pairs hold fill_value
+    '''
+    def resize(self, num_edges):
+        old_dists = self.dists
+        old_num_edges = min(self.num_edges, num_edges)
+        if self.path is None:
+            self.dists = np.full((num_edges, num_edges), self.fill_value, dtype=old_dists.dtype)
+            self.dists[:old_num_edges,:old_num_edges] = old_dists[:old_num_edges,:old_num_edges]
+        else:
+            # copy into a new file then replace the old one, memory maps of the old file stay valid
+            new_path = self.path + '.new'
+            self.dists = self.openFile(new_path, num_edges, old_dists.dtype)
+            for start in range(0, old_num_edges, 1024):
+                end = min(start + 1024, old_num_edges)
+                self.dists[start:end,:old_num_edges] = old_dists[start:end,:old_num_edges]
+            self.dists.flush()
+            os.replace(new_path, self.path)
+        self.num_edges = num_edges
+
+    '''
+    writes the stored dists to the file, if memory mapped
+    '''
+    def flush(self):
+        if isinstance(self.dists, np.memmap):
+            self.dists.flush()
+
+    '''
+    stores the dists for each pair of edge ids, in both orders
+    '''
+    def setDists(self, edge_indices1, edge_indices2, dists):
+        self.dists[edge_indices1, edge_indices2] = dists
+        self.dists[edge_indices2, edge_indices1] = dists
+        self.num_stored += len(dists)
+
+    '''
+    returns the dist btw two edge ids, or None if it isn't known
+    '''
+    def getDist(self, edge_index1, edge_index2):
+        dist = self.dists.item(edge_index1, edge_index2)
+        if dist != dist:
+            return None
+        return dist
+
+    '''
+    returns the dists btw an edge id and each of the edge ids, nan where they aren't known
+    '''
+    def getDists(self, edge_index, edge_indices):
+        return np.array(self.dists[edge_index, edge_indices], dtype=np.float64)
+
+    '''
+    returns the dist btw each pair (edge_indices1[i], edge_indices2[i]), nan where they aren't known
+    '''
+    def getPairDists(self, edge_indices1, edge_indices2):
+        return np.array(self.dists[edge_indices1, edge_indices2], dtype=np.float64)
+
+    def __len__(self):
+        return self.num_stored
+
+'''
+The SparseEdgeDists class stores the same dists as EdgeDists, but only for the pairs that were set,
+for when only the shape candidates were compared (see EdgeMatrix.getShapeCandidates) and most of
+the matrix would be unknown. Uses the same layout as NeighborIndex: the edge ids paired with edge
+id i are neighbors[indptr[i]:indptr[i+1]], in increasing order, with their dists in the same
+positions of values. Both orders of a pair are stored. Dists that aren't stored are unknown.
+'''
+class SparseEdgeDists:
+    def __init__(self, num_edges, dtype=np.float32):
+        self.num_edges = num_edges
+        self.fill_value = float('nan')
+        self.neighbors = np.empty(0, dtype=np.int32)
+        self.values = np.empty(0, dtype=dtype)
+        self.indptr = np.zeros(num_edges + 1, dtype=np.int64)
+        self.num_stored = 0
+        # DistMemo for dists found as the solver goes, for pairs that aren't stored
+        self.memo = None
+
+    '''
+    makes room for edges added after the dists were stored, with no pairs
+    '''
+    def resize(self, num_edges):
+        if num_edges > self.num_edges:
+            self.indptr = np.concatenate((self.indptr, np.full(num_edges - self.num_edges, self.indptr[-1])))
+        self.num_edges = num_edges
+
+    def flush(self):
+        pass
+
+    '''
+    stores the dists for each pair of edge ids, in both orders. Pairs that were already stored are
+    replaced. All of the pairs are sorted again, so it's best to set them in a few big batches
+    '''
+    def setDists(self, edge_indices1, edge_indices2, dists):
+        counts = np.diff(self.indptr)
+        edges = np.concatenate((np.repeat(np.arange(self.num_edges), counts), edge_indices1, edge_indices2)).astype(np.int64)
+        others = np.concatenate((self.neighbors, edge_indices2, edge_indices1)).astype(np.int64)
+        values = np.concatenate((self.values, np.asarray(dists, dtype=self.values.dtype), np.asarray(dists, dtype=self.values.dtype)))
+
+        # sort by edge then other edge, keeping the last dist set for each pair
+        keys = (edges << 32) | others
+        order = np.argsort(keys, kind='stable')
+        last = np.append(keys[order][1:] != keys[order][:-1], True)
+        order = order[last]
+
+        self.neighbors = others[order].astype(np.int32)
+        self.values = values[order]
+        self.indptr = np.searchsorted(edges[order], np.arange(self.num_edges + 1))
+        self.num_stored += len(dists)
+
+    '''
+    returns the dist btw two edge ids, or None if it isn't known
+    '''
+    def getDist(self, edge_index1, edge_index2):
+        start, end = self.indptr.item(edge_index1), self.indptr.item(edge_index1 + 1)
+        position = start + int(self.neighbors[start:end].searchsorted(edge_index2))
+        if position < end and self.neighbors.item(position) == edge_index2:
+            return self.values.item(position)
+        return None
+
+    '''
+    returns the dists btw an edge id and each of the edge ids, nan where they aren't known
+    '''
+    def getDists(self, edge_index, edge_indices):
+        edge_indices = np.asarray(edge_indices)
+        dists = np.full(len(edge_indices), np.nan)
+        start, end = self.indptr.item(edge_index), self.indptr.item(edge_index + 1)
+        if end > start:
+            row = self.neighbors[start:end]
+            positions = np.minimum(row.searchsorted(edge_indices), end - start - 1)
+            found = row[positions] == edge_indices
+            dists[found] = self.values[start + positions[found]]
+        return dists
+
+    '''
+    returns the dist btw each pair (edge_indices1[i], edge_indices2[i]), nan where they aren't known
+    '''
+    def getPairDists(self, edge_indices1, edge_indices2):
+        edges = np.repeat(np.arange(self.num_edges, dtype=np.int64), np.diff(self.indptr))
+        keys = (edges << 32) | self.neighbors
+        pair_keys = (np.asarray(edge_indices1, dtype=np.int64) << 32) | np.asarray(edge_indices2, dtype=np.int64)
+        dists = np.full(len(pair_keys), np.nan)
+        if len(keys) > 0:
+            positions = np.minimum(keys.searchsorted(pair_keys), len(keys) - 1)
+            found = keys[positions] == pair_keys
+            dists[found] = self.values[positions[found]]
+        return dists
+
+    def __len__(self):
+        return self.num_stored
+
+'''
+The DistMemo class remembers the most recently used dists that weren't in the EdgeDists, so pairs
+that have to be compared as the solver goes are only compared once while they're in use. It holds
+at most max_size dists, and drops the least recently used one when it's full. It's kept on the
+EdgeDists, so every solution using the same dists shares it, and new weights start a new one.
+'''
+class DistMemo:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.dists = OrderedDict() # (edge id, edge id) to dist, least recently used first
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    '''
+    returns the dist btw two edge ids, or None if it isn't remembered
+    '''
+    def get(self, edge_index1, edge_index2):
+        # dists are the same both ways, so each pair is kept once
+        key = (min(edge_index1, edge_index2), max(edge_index1, edge_index2))
+        dist = self.dists.get(key)
+        if dist is None:
+            self.misses += 1
+            return None
+        self.dists.move_to_end(key)
+        self.hits += 1
+        return dist
+
+    '''
+    remembers the dist btw two edge ids, forgetting the least recently used dist if full
+    '''
+    def add(self, edge_index1, edge_index2, dist):
+        if self.max_size <= 0:
+            return
+        self.dists[(min(edge_index1, edge_index2), max(edge_index1, edge_index2))] = dist
+        if len(self.dists) > self.max_size:
+            self.dists.popitem(last=False)
+            self.evictions += 1
+
+    '''
+    returns a string with the number of hits, misses and evictions
+    '''
+    def getStats(self):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups > 0 else 0
+        return f'dist memo: {len(self.dists)}/{self.max_size} dists, {self.hits} hits, {self.misses} misses ({hit_rate:.1%} hits), {self.evictions} evictions'
+
+    def __len__(self):
+        return len(self.dists)
+
+'''
+The NeighborIndex class holds the closest edges to each edge, in order of increasing dist.
+The edge ids for all edges are stored in one int32 array, with the edges for edge id i in
+neighbors[indptr[i]:indptr[i+1]], so index[i] gives a slice of the array without copying.
+The first num_closest[i] of them are the closest edges, any after are from addReciprocalEdges.
+'''
+class NeighborIndex:
+    def __init__(self, neighbors, indptr, num_closest=None):
+        self.neighbors = neighbors
+        self.indptr = indptr
+        if num_closest is None:
+            num_closest = np.diff(indptr)
+        self.num_closest = num_closest
+
+    '''
+    finds the closest num_to_include[i] edges for each edge id i, using a matrix of dists btw edge ids
+    where pairs that can't be matched are inf. rows are handled in blocks of block_size
+    rows - if set, only these edge ids get any edges, in increasing order
+    '''
+    @classmethod
+    def fromDists(cls, dists, num_to_include, block_size=256, rows=None):
+        if isinstance(dists, SparseEdgeDists):
+            return cls.fromSparseDists(dists, num_to_include, rows)
+        num_edges = len(dists)
+        num_to_include = np.minimum(num_to_include, num_edges)
+        if rows is None:
+            rows = np.arange(num_edges)
+        neighbors = []
+        counts = np.zeros(num_edges, dtype=np.int64)
+        for start in range(0, len(rows), block_size):
+            block_rows = rows[start:start + block_size]
+            k = int(np.max(num_to_include[block_rows]))
+            if k == 0:
+                continue
+            block = dists[block_rows]
+            # the k closest in any order, then sort just those by dist, ties by edge id
+            if k < num_edges:
+                closest = np.argpartition(block, k - 1, axis=1)[:,:k]
+            else:
+                closest = np.broadcast_to(np.arange(num_edges), block.shape)
+            closest_dists = np.take_along_axis(block, closest, axis=1)
+            order = np.lexsort((closest, closest_dists), axis=1)
+            closest = np.take_along_axis(closest, order, axis=1)
+            closest_dists = np.take_along_axis(closest_dists, order, axis=1)
+
+            keep = np.isfinite(closest_dists) & (np.arange(k) < num_to_include[block_rows,np.newaxis])
+            neighbors.append(closest[keep])
+            counts[block_rows] = np.sum(keep, axis=1)
+
+        neighbors = np.concatenate(neighbors).astype(np.int32) if len(neighbors) > 0 else np.empty(0, dtype=np.int32)
+        indptr = np.concatenate(([0], np.cumsum(counts)))
+        return cls(neighbors, indptr)
+
+    '''
+    same as fromDists, but from the pairs stored in a SparseEdgeDists, without making the matrix
+    '''
+    @classmethod
+    def fromSparseDists(cls, dists, num_to_include, rows=None):
+        num_to_include = np.minimum(num_to_include, dists.num_edges)
+        if not rows is None:
+            included = np.zeros(dists.num_edges, dtype=bool)
+            included[rows] = True
+            num_to_include = np.where(included, num_to_include, 0)
+        counts = np.diff(dists.indptr)
+        edges = np.repeat(np.arange(dists.num_edges), counts)
+        # sorted by edge then dist, ties by edge id, and the first num_to_include of each edge are kept
+        order = np.lexsort((dists.neighbors, dists.values, edges))
+        positions = np.arange(len(order)) - np.repeat(dists.indptr[:-1], counts)
+        keep = (positions < num_to_include[edges]) & np.isfinite(dists.values[order])
+        order = order[keep]
+
+        counts = np.bincount(edges[order], minlength=dists.num_edges)
+        indptr = np.concatenate(([0], np.cumsum(counts)))
+        return cls(dists.neighbors[order], indptr)
+
+    '''
+    if edge j is one of the closest edges to edge i, but edge i isn't one of the closest to edge j,
+    adds edge i to the end of the edges for j. Only done for edges with num_to_include > 0
+    '''
+    def addReciprocalEdges(self, num_to_include):
+        num_edges = len(self.indptr) - 1
+        edges = np.repeat(np.arange(num_edges), np.diff(self.indptr))
+        others = self.neighbors.astype(np.int64)
+        missing = ~np.isin(others * num_edges + edges, edges * num_edges + others)
+        missing &= np.asarray(num_to_include)[others] > 0
+
+        # closest edges first, then the added edges in order of edge id
+        all_edges = np.concatenate((edges, others[missing]))
+        all_others = np.concatenate((others, edges[missing]))
+        added = np.concatenate((np.zeros(len(edges), dtype=bool), np.ones(np.sum(missing), dtype=bool)))
+        position = np.concatenate((np.arange(len(edges)), edges[missing]))
+        order = np.lexsort((position, added, all_edges))
+
+        self.neighbors = all_others[order].astype(np.int32)
+        self.indptr = np.searchsorted(all_edges[order], np.arange(num_edges + 1))
+
+    '''
+    updates the index after edges were added to the dists, new edges have ids after the old ones.
+    Only the rows of the new edges, and of the old edges where a new edge is closer than the last
+    of their closest edges, are found again. If bounds_changed, every dist changed so all are.
+    The edges added by addReciprocalEdges are dropped, call it again after
+    '''
+    def update(self, dists, num_to_include, bounds_changed=False):
+        sparse = isinstance(dists, SparseEdgeDists)
+        num_edges = dists.num_edges if sparse else len(dists)
+        num_old_edges = len(self.indptr) - 1
+        num_to_include = np.minimum(num_to_include, num_edges)
+        # finding the closest edges again from sparse dists is about as fast as checking which changed
+        if bounds_changed or sparse:
+            updated = self.fromDists(dists, num_to_include)
+            self.neighbors, self.indptr, self.num_closest = updated.neighbors, updated.indptr, updated.num_closest
+            return
+
+        # dist to the last of the closest edges for each old edge, inf if it has room for more
+        old_rows = np.nonzero(num_to_include[:num_old_edges] > 0)[0]
+        last_dists = np.full(len(old_rows), float('inf'))
+        full = self.num_closest[old_rows] >= num_to_include[old_rows]
+        last = self.indptr[old_rows[full]] + self.num_closest[old_rows[full]] - 1
+        last_dists[full] = dists[old_rows[full], self.neighbors[last]]
+        closer = np.zeros(len(old_rows), dtype=bool)
+        for start in range(0, len(old_rows), 1024):
+            new_dists = dists[old_rows[start:start + 1024], num_old_edges:]
+            closer[start:start + 1024] = np.any(new_dists < last_dists[start:start + 1024,np.newaxis], axis=1)
+        rows = np.concatenate((old_rows[closer], np.arange(num_old_edges, num_edges)))
+        updated = self.fromDists(dists, num_to_include, rows=rows)
+
+        # keep the closest edges of the rows that weren't found again
+        num_closest = np.zeros(num_edges, dtype=np.int64)
+        num_closest[:num_old_edges] = self.num_closest
+        num_closest[rows] = 0
+        counts = np.diff(self.indptr)
+        edges = np.repeat(np.arange(num_old_edges), counts)
+        positions = np.arange(len(self.neighbors)) - np.repeat(self.indptr[:-1], counts)
+        keep = positions < num_closest[edges]
+
+        all_edges = np.concatenate((edges[keep], np.repeat(np.arange(num_edges), updated.num_closest)))
+        order = np.argsort(all_edges, kind='stable')
+        self.neighbors = np.concatenate((self.neighbors[keep], updated.neighbors))[order]
+        self.num_closest = num_closest + updated.num_closest
+        self.indptr = np.concatenate(([0], np.cumsum(self.num_closest)))
+
+    '''
+    returns True if edge_index2 is one of the first num_to_check edges for edge_index1
+    '''
+    def isClose(self, edge_index1, edge_index2, num_to_check):
+        start = self.indptr[edge_index1]
+        end = min(self.indptr[edge_index1 + 1], start + num_to_check)
+        return edge_index2 in self.neighbors[start:end].tolist()
+
+    def __getitem__(self, edge_index):
+        return self.neighbors[self.indptr[edge_index]:self.indptr[edge_index + 1]]
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+'''
+finds how many of the closest edges in neighbor_index (found by comparing every pair) are in the
+candidate pairs (edges1, edges2) from EdgeMatrix.getShapeCandidates
+returns the fraction of all the closest edges that are candidates, and the same for just the closest one
+'''
+def getCandidateRecall(neighbor_index, edges1, edges2):
+    num_edges = len(neighbor_index)
+    candidates = np.concatenate((edges1 * num_edges + edges2, edges2 * num_edges + edges1))
+    counts = np.diff(neighbor_index.indptr)
+    edges = np.repeat(np.arange(num_edges), counts)
+    found = np.isin(edges * num_edges + neighbor_index.neighbors, candidates)
+    if len(found) == 0:
+        return 1.0, 1.0
+    firsts = neighbor_index.indptr[:-1][counts > 0]
+    return float(np.mean(found)), float(np.mean(found[firsts]))
+
+'''
+returns the min and max of each metric in the raw metrics, or None if there are none
+'''
+def getBounds(raw_metrics):
+    if len(raw_metrics) == 0:
+        return None
+    mins = [float(np.min(raw_metrics[name])) for name in METRIC_NAMES]
+    maxs = [float(np.max(raw_metrics[name])) for name in METRIC_NAMES]
+    return mins, maxs
+
+'''
+combines the bounds found for separate blocks of raw metrics
+'''
+def mergeBounds(bounds_list):
+    bounds_list = [bounds for bounds in bounds_list if not bounds is None]
+    if len(bounds_list) == 0:
+        return None
+    mins = np.min([bounds[0] for bounds in bounds_list], axis=0).tolist()
+    maxs = np.max([bounds[1] for bounds in bounds_list], axis=0).tolist()
+    return mins, maxs
+
+'''
+copies the arrays into shared memory so that worker processes can read them without copying
+returns the shared memory blocks, which must be freed with freeArrays, and a spec used to open
+them in the workers with openArrays
+'''
+def shareArrays(arrays):
+    shared_arrays = []
+    spec = {}
+    for name, value in arrays.items():
+        value = np.ascontiguousarray(value)
+        shared = shared_memory.SharedMemory(create=True, size=max(1, value.nbytes))
+        np.ndarray(value.shape, dtype=value.dtype, buffer=shared.buf)[...] = value
+        shared_arrays.append(shared)
+        spec[name] = (shared.name, value.shape, value.dtype)
+    return shared_arrays, spec
+
+def openArrays(spec):
+    shared_arrays = []
+    arrays = {}
+    for name, (shared_name, shape, dtype) in spec.items():
+        shared = shared_memory.SharedMemory(name=shared_name)
+        shared_arrays.append(shared)
+        arrays[name] = np.ndarray(shape, dtype=dtype, buffer=shared.buf)
+    return shared_arrays, arrays
+
+def freeArrays(shared_arrays):
+    for shared in shared_arrays:
+        shared.close()
+        shared.unlink()
+
+# state of a worker process, set up by the initializer of the pool
+worker_state = {}
+
+def initMatrixWorker(spec):
+    worker_state['shared_arrays'], arrays = openArrays(spec)
+    worker_state['edge_matrix'] = EdgeMatrix.fromArrays(arrays)
+
+def compareRowsInWorker(rows, first_col=0):
+    return worker_state['edge_matrix'].getRawMetricsForRows(rows, first_col)
+
+def comparePairsInWorker(pairs):
+    return worker_state['edge_matrix'].getRawMetricsForPairs(pairs)
@@ -2,14 +2,18 @@ import numpy as np
 from scipy.signal import find_peaks
 import matplotlib.pyplot as plt
 import math
+import itertools
 import imutils
 import cv2
 
-from edge import Edge
+from edge import Edge, EdgeTable, getEquidistantPoints
+
+# pixels kept around the piece in its patch, enough for the details drawn by getSubimage2
+PATCH_PADDING = 16
 
 '''
 The piece class contains all information about puzzle pieces.
-The image is the image containing the piece in it,
+The image is the patch of the photo containing the piece, with the mask of the piece in it,
 the contour is the location of all the points around the edge of the piece
 the label is a value used to describe the piece
 the corners, edge objects, and type of the piece are all found.
@@ -18,17 +22,56 @@ The subimage containing the piece, cropped and rotated appropriately can be foun
 getSubimage
 '''
 class Piece:
-    def __init__(self, label, number, image, contour, settings):
+    __slots__ = ('label', 'number', 'contour', 'image', 'image_offset', 'mask', 'corners', 'settings', 'edges', 'type')
+
+    def __init__(self, label, number, image, contour, settings, image_offset=(0, 0)):
         self.label = label # distinct label for piece
         self.number = number # index of piece in the collection's piece list
-        self.image = image # image containing the piece
         self.contour = contour # contour along the edge of the piece
+        self.setPatch(image, image_offset) # patch of the image containing the piece
         self.findCorners() # find the corner locations for the piece
         self.settings = settings
         self.findEdges() # find the edges of the piece, as Edge objects
         self.getEdgeColors() # find colors for each edge, store in the Edge objects
         self.findType() # side, middle, or corner
 
+    '''
+    makes a Piece from corners and edges that were already found, e.g. loaded from the cache in
+    puzzleCache, without finding them again. If the mask is given, image is the patch of the piece
+    already cut from the photo at image_offset, as kept by setPatch
+    '''
+    @classmethod
+    def fromDescriptors(cls, label, number, image, contour, settings, corners, edges, image_offset=(0, 0), mask=None):
+        piece = cls.__new__(cls)
+        piece.label = label
+        piece.number = number
+        piece.contour = contour
+        if mask is None:
+            piece.setPatch(image, image_offset)
+        else:
+            piece.image, piece.image_offset, piece.mask = image, np.array(image_offset), mask
+        piece.corners = corners
+        piece.settings = settings
+        # link the edges to their neighbors, same as findEdges
+        for i, edge in enumerate(edges):
+            edge.setLeftNeighbor(edges[i-1])
+            edges[i-1].setRightNeighbor(edge)
+        for edge in edges:
+            edge.findSignature()
+        piece.edges = edges
+        piece.findType()
+        return piece
+
+    '''
+    keeps just the part of the image around the piece and a mask of the piece in it, so the
+    piece doesn't hold on to the whole photo. image_offset is the x, y of the image in the photo,
+    if it is just part of it
+    '''
+    def setPatch(self, image, image_offset=(0, 0)):
+        self.image, self.image_offset = getPatch(image, self.contour, image_offset)
+        self.mask = np.zeros(self.image.shape[:2], dtype=np.uint8)
+        cv2.drawContours(self.mask, [self.contour], -1, 255, thickness=-1, offset=(-int(self.image_offset[0]), -int(self.image_offset[1])))
+
     '''
     finds a cropped and rotated image for the piece, using the image the piece is in
     can be resized
@@ -37,17 +80,17 @@ class Piece:
     '''
     def getSubimage2(self, edge_up, with_details=False, resize_factor=1, draw_edges=[], rel_edge=0, line_width=0):
         image = self.image.copy()
-        h, w, _ = image.shape
+        ox, oy = int(self.image_offset[0]), int(self.image_offset[1])
 
         # used in demo to show edges on the piece
         for edge in range(4):
             if edge in draw_edges and len(draw_edges) == 4:
-                cv2.drawContours(image, self.edges[edge].contour, -1, (0,255,0), thickness=10)
+                cv2.drawContours(image, self.edges[edge].contour, -1, (0,255,0), thickness=10, offset=(-ox, -oy))
 
-        cv2.drawContours(image, self.contour, -1, (0,0,0), thickness=line_width)
+        cv2.drawContours(image, self.contour, -1, (0,0,0), thickness=line_width, offset=(-ox, -oy))
 
         # find a circle that encloses the piece in the image
-        (x,y), r = cv2.minEnclosingCircle(self.contour)
+        (x,y), r = getEnclosingCircle(self.contour)
         x = int(x)
         y = int(y)
         r = int(r)
@@ -58,25 +101,15 @@ class Piece:
         if x - r < 0:
             x = r
 
-        h, w, _ = self.image.shape
-        
-        lpad = rpad = tpad = bpad = 0
-        if y - r < 0:
-            tpad = -(y - r)
-        if x - r < 0:
-            lpad = -(x - r)
-
-        # isolate the piece in the image
-        mask = np.zeros_like(image)
-        cv2.drawContours(mask, [self.contour], -1, (255,255,255), thickness=-1)
-        image_piece_isolated = cv2.bitwise_and(mask, image)
+        # isolate the piece in the patch
+        image_piece_isolated = cv2.bitwise_and(image, image, mask=self.mask)
 
         # show details if specified
         if with_details:
             for i, corner in enumerate(self.corners):
                 prev = self.corners[i-1]
-                cv2.circle(image_piece_isolated, (int(corner[1]), int(corner[2])), 10, (0, 255, 255), thickness=-1, lineType=cv2.FILLED)
-                cv2.line(image_piece_isolated, (int(corner[1]), int(corner[2])), (int(prev[1]), int(prev[2])), 
+                cv2.circle(image_piece_isolated, (int(corner[1]) - ox, int(corner[2]) - oy), 10, (0, 255, 255), thickness=-1, lineType=cv2.FILLED)
+                cv2.line(image_piece_isolated, (int(corner[1]) - ox, int(corner[2]) - oy), (int(prev[1]) - ox, int(prev[2]) - oy),
                         (0,255,0), thickness=1)
 
             for i, edge in enumerate(self.edges):
@@ -87,14 +120,16 @@ class Piece:
                 else:
                     color = (0,0,255)
 
-                cv2.drawContours(image_piece_isolated, edge.contour, -1, color, thickness=5)
+                cv2.drawContours(image_piece_isolated, edge.contour, -1, color, thickness=5, offset=(-ox, -oy))
 
-        # crop to the circle
-        image_crop = image_piece_isolated[max(y-r, 0):min(y+r, h),max(x-r, 0):min(x+r, w)]
-        h1, w1, _ = image_crop.shape
+        # crop to the circle, the rest of the circle is outside of the patch so it is empty
+        h, w, _ = image_piece_isolated.shape
+        top, left = max(y-r, oy), max(x-r, ox)
+        bottom, right = min(y+r, oy+h), min(x+r, ox+w)
 
         padded_image = np.zeros((2*r, 2*r, 3), dtype=np.uint8)
-        padded_image[tpad:tpad+h1, lpad:lpad+w1] = image_crop
+        if bottom > top and right > left:
+            padded_image[top-(y-r):bottom-(y-r), left-(x-r):right-(x-r)] = image_piece_isolated[top-oy:bottom-oy, left-ox:right-ox]
 
         ph, pw, _ = padded_image.shape
 
@@ -212,10 +247,13 @@ class Piece:
     uses heuristics of sharpness, area covered, and rectangulareness to determine corners
     i.e. corners have high sharpness, high rectangularness, and high area covered
     relative to other subsets of the peaks
+    the rectangularness and sharpness are found for every subset of 4 peaks at once. The area
+    covered is slow to find, so it's only found for the subsets that could still have the best
+    score, from the highest possible score down. Gives the same corners as trying every subset
     '''
     def pickBestPeaks( self, peaks, sharpness ):
         # crop the image for efficiency
-        (x,y), r = cv2.minEnclosingCircle(self.contour)
+        (x,y), r = getEnclosingCircle(self.contour)
         r = int(r)
         x = int(x)
         y = int(y)
@@ -224,58 +262,82 @@ class Piece:
         cv2.drawContours(img3, [adj_contour], -1, 255, thickness=-1)
         maxScore = -1
         maxPeaks = [0, 1, 2, 3]
+        if len(peaks) < 4:
+            return np.array(maxPeaks)
 
         # normalize sharpness
         sharpness = ((sharpness - np.min(sharpness)) / (np.max(sharpness) - np.min(sharpness)))
 
-        # iterate over subsets
-        for i in range(len(peaks)):
-            peak1 = peaks[i]
-            for j in range(i+1, len(peaks)):
-                peak2 = peaks[j]
-                for k in range(j+1, len(peaks)):
-                    peak3 = peaks[k]
-                    for l in range(k+1, len(peaks)):
-                        peak4 = peaks[l]
-                        img2 = np.zeros_like(img3)
-                        point1 = [adj_contour[peak1][0][0],  adj_contour[peak1][0][1]]
-                        point2 = [adj_contour[peak2][0][0],  adj_contour[peak2][0][1]]
-                        point3 = [adj_contour[peak3][0][0],  adj_contour[peak3][0][1]]
-                        point4 = [adj_contour[peak4][0][0],  adj_contour[peak4][0][1]]
-
-                        points = np.array([point1, point2, point3, point4])
-                        
-                        # find the area covered by the set of peaks
-                        cv2.fillPoly(img2, pts=[points], color =255)
-                        img4 = cv2.bitwise_and(img2, img3)
-
-                        covered_area = np.sum(img4 == 255)
-
-                        # find the rectangle that bounds the peaks
-                        x,y,w,h = cv2.boundingRect(points)
-                        rect = ((x, y), (w, h), 0)
-                        box = cv2.boxPoints(rect)
-                        box = np.int0(box)
-
-                        # find the area covered by the box, and the area of the points
-                        area_rect = cv2.contourArea(box)
-                        area_points = cv2.contourArea(np.array([adj_contour[peak1], adj_contour[peak2], adj_contour[peak3], adj_contour[peak4]]))
-
-                        # maximum when points form perfect rectangle
-                        if area_rect > 0:
-                            score_rect = (area_points / area_rect) ** (1/2)
-                        else:
-                            score_rect = 0
-
-                        # maximum when all points are maximum sharpness
-                        score_sharp = ((sharpness[i] + sharpness[j] + sharpness[k] + sharpness[l]) - max(sharpness[i], sharpness[j], sharpness[k], sharpness[l]))**(1/4)
-                        
-                        # combine metrics
-                        score = (covered_area)*score_rect*score_sharp
-
-                        if score > maxScore:
-                            maxPeaks = [peak1, peak2, peak3, peak4]
-                            maxScore = score
+        # every subset of 4 peaks, in the same order as nested loops over the peaks
+        subsets = np.array(list(itertools.combinations(range(len(peaks)), 4)))
+        all_points = adj_contour[peaks[subsets], 0].astype(np.int32)
+        xs, ys = all_points[:,:,0].astype(np.int64), all_points[:,:,1].astype(np.int64)
+
+        # area of the rectangle that bounds the peaks, same as cv2.boxPoints of the bounding rect
+        # centered on its corner, rounded towards zero
+        x0, y0 = np.min(xs, axis=1), np.min(ys, axis=1)
+        widths = np.max(xs, axis=1) - x0 + 1
+        heights = np.max(ys, axis=1) - y0 + 1
+        area_rect = (np.trunc(x0 + widths / 2) - np.trunc(x0 - widths / 2)) * (np.trunc(y0 + heights / 2) - np.trunc(y0 - heights / 2))
+        # area of the points, shoelace formula
+        area_points = np.abs(np.sum(xs * np.roll(ys, -1, axis=1) - np.roll(xs, -1, axis=1) * ys, axis=1)) / 2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scores_rect = np.where(area_rect > 0, np.sqrt(area_points / area_rect), 0)
+        subset_sharpness = sharpness[subsets]
+        scores_sharp = (np.sum(subset_sharpness, axis=1) - np.max(subset_sharpness, axis=1))**(1/4)
+
+        # the area covered is at most the area of the piece, and the area of the bounding rect
+        piece_area = np.sum(img3 == 255)
+        max_scores = np.minimum(widths * heights, piece_area) * scores_rect * scores_sharp
+        # NaN scores are never better, same as comparing them
+        order = np.argsort(-np.nan_to_num(max_scores, nan=-np.inf), kind='stable')
+
+        best = None
+        for index in order:
+            # allow a little for rounding, a subset with an equal score can still be picked
+            # if it comes first
+            if not max_scores[index] * (1 + 1e-9) >= maxScore:
+                break
+            i, j, k, l = subsets[index]
+            peak1, peak2, peak3, peak4 = peaks[subsets[index]]
+            points = all_points[index]
+
+            # find the area covered by the set of peaks, just in the bounding rect of the peaks
+            x,y,w,h = cv2.boundingRect(points)
+            img2 = np.zeros((h, w), dtype=np.uint8)
+            cv2.fillPoly(img2, pts=[(points - [x, y]).astype(np.int32)], color=255)
+            img4 = np.zeros_like(img2)
+            crop = img3[max(y, 0):y + h, max(x, 0):x + w]
+            img4[max(-y, 0):max(-y, 0) + crop.shape[0], max(-x, 0):max(-x, 0) + crop.shape[1]] = crop
+            img4 = cv2.bitwise_and(img2, img4)
+
+            covered_area = np.sum(img4 == 255)
+
+            # find the rectangle that bounds the peaks
+            rect = ((x, y), (w, h), 0)
+            box = cv2.boxPoints(rect)
+            box = np.int0(box)
+
+            # find the area covered by the box, and the area of the points
+            area_rect = cv2.contourArea(box)
+            area_points = cv2.contourArea(np.array([adj_contour[peak1], adj_contour[peak2], adj_contour[peak3], adj_contour[peak4]]))
+
+            # maximum when points form perfect rectangle
+            if area_rect > 0:
+                score_rect = (area_points / area_rect) ** (1/2)
+            else:
+                score_rect = 0
+
+            # maximum when all points are maximum sharpness
+            score_sharp = ((sharpness[i] + sharpness[j] + sharpness[k] + sharpness[l]) - max(sharpness[i], sharpness[j], sharpness[k], sharpness[l]))**(1/4)
+
+            # combine metrics
+            score = (covered_area)*score_rect*score_sharp
+
+            if score > maxScore or (score == maxScore and index < best):
+                maxPeaks = [peak1, peak2, peak3, peak4]
+                maxScore = score
+                best = index
 
         return np.array(maxPeaks)
 
@@ -286,16 +348,25 @@ class Piece:
         # init edges to empty
         edges = []
 
-        # for each set of corners next to eachother
+        # get the contour between each set of corners next to eachother
+        edge_contours = []
         for i in range(len(self.corners)):
             # get the corner positions in the contour
             c1_pos = self.corners[i-1][0]
             c2_pos = self.corners[i][0]
-            # add a new edge which contains the contour between these two positions
             if c2_pos < c1_pos:
-                new_edge = Edge(i, np.concatenate((self.contour[c1_pos:], self.contour[:c2_pos])), self.settings)
+                edge_contours.append(np.concatenate((self.contour[c1_pos:], self.contour[:c2_pos])))
             else:
-                new_edge = Edge(i, self.contour[c1_pos:c2_pos], self.settings)
+                edge_contours.append(self.contour[c1_pos:c2_pos])
+
+        # space points equally along all of the edges at once
+        equidistant_points = getEquidistantPoints(edge_contours, self.settings[2])
+        # the edges store their metrics in one table, moved to the collection's table when the piece is added
+        edge_table = EdgeTable()
+
+        for i, edge_contour in enumerate(edge_contours):
+            # add a new edge which contains the contour between these two positions
+            new_edge = Edge(i, edge_contour, self.settings, equidistant_points[i], edge_table)
             if len(edges) > 0:
                 prev_edge = edges[-1]
                 prev_edge.setRightNeighbor(new_edge)
@@ -304,6 +375,9 @@ class Piece:
 
         edges[0].setLeftNeighbor(edges[-1])
         edges[-1].setRightNeighbor(edges[0])
+        # which edges each edge can be compared to, now that its neighbors are known
+        for edge in edges:
+            edge.findSignature()
 
         self.edges = edges
 
@@ -313,124 +387,109 @@ class Piece:
     '''
     def getEdgeColors(self):
         # crop for efficiency
-        (x,y), r = cv2.minEnclosingCircle(self.contour)
+        (x,y), r = getEnclosingCircle(self.contour)
         r = int(r)
         x = int(x)
         y = int(y)
 
         h, w, _ = self.image.shape
+        # position of the circle in the image
+        image_x, image_y = x - self.image_offset[0], y - self.image_offset[1]
         
         lpad = rpad = tpad = bpad = 0
-        if y - r < 0:
-            tpad = -(y - r)
-        if x - r < 0:
-            lpad = -(x - r)
-
-        # isolate the piece in the image
-        mask = np.zeros_like(self.image)
-        cv2.drawContours(mask, [self.contour], -1, (255,255,255), thickness=-1)
-        image_piece_isolated = cv2.bitwise_and(mask, self.image)
-
-        # crop to the circle
-        image_crop = image_piece_isolated[max(y-r, 0):min(y+r, h),max(x-r, 0):min(x+r, w)]
+        if image_y - r < 0:
+            tpad = -(image_y - r)
+        if image_x - r < 0:
+            lpad = -(image_x - r)
+
+        # crop to the circle, then isolate the piece in the crop
+        crop_x, crop_y = max(image_x-r, 0), max(image_y-r, 0)
+        image_crop = self.image[crop_y:min(image_y+r, h),crop_x:min(image_x+r, w)]
+        image_crop = cv2.bitwise_and(image_crop, image_crop, mask=self.mask[crop_y:crop_y+image_crop.shape[0],crop_x:crop_x+image_crop.shape[1]])
         h1, w1, _ = image_crop.shape
 
         padded_image = np.zeros((2*r, 2*r, 3), dtype=np.uint8)
         padded_image[tpad:tpad+h1, lpad:lpad+w1] = cv2.cvtColor(image_crop, cv2.COLOR_BGR2LAB)
         padded_image[:,:,0] = padded_image[:,:,0] // 2
+        # the 16x16x16 histogram bin of each pixel, as one number, so the histogram of any set of
+        # pixels is a bincount
+        hist_bins = ((padded_image[:,:,0] >> 4).astype(np.int32) << 8) | ((padded_image[:,:,1] >> 4) << 4) | (padded_image[:,:,2] >> 4)
 
         # erode the mask in order to increase accuracy
         kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (7,7))
 
-        adj_contour = self.contour - [x-r+lpad, y-r+tpad]
+        # the contours are placed relative to the corner of the circle in the photo, moved inside of the photo
+        contour_offset = [max(x-r, 0), max(y-r, 0)]
+        adj_contour = self.contour - contour_offset
         piece_mask = np.zeros((2*r, 2*r), dtype=np.uint8)
 
         cv2.drawContours(piece_mask, [adj_contour], -1, 255, thickness=-1)
         piece_mask = cv2.erode(piece_mask, kernel, iterations=1)
 
-        # for showing the colors as in the presentation
-        piece_mask_show = np.zeros_like(padded_image)
-        color_images = []
-
         # iterate over edges
         for i, edge in enumerate(self.edges):
             # adjust the contour to fit within the cropped image
-            adj_contour = edge.contour - [x-r+lpad, y-r+tpad]
-            edge_mask = np.zeros((2*r, 2*r), dtype=np.uint8)
-            img_show = np.zeros((2*r, 2*r, 3), dtype=np.uint8)
-            edge_colors = None
+            adj_contour = edge.contour - contour_offset
+            edge_colors = []
             edge_color_hists = []
 
             # find indices to look for a contour in
-            hist_mask = np.zeros_like(edge_mask)
+            hist_mask = np.zeros((2*r, 2*r), dtype=np.uint8)
             hist_indices = np.linspace(2, edge.points_per_side - 3, max(4, edge.points_per_side // 8)).astype(int)[1:]
             
-            starting_points = []
-            corresponding_points = []
-            # find points to look for color in
-            for j in range(0, edge.points_per_side-1):
-                if j == edge.points_per_side - 1:
-                    p1 = adj_contour[j][0]
-                    p2 = adj_contour[j-1][0]
-                    dx, dy = p1 - p2
-                else:
-                    p1 = adj_contour[j][0]
-                    p2 = adj_contour[j+1][0]
-                    dx, dy = p2 - p1
-
-                if dx == 0 and dy == 0:
-                    if j > 0:
-                        starting_points.append(starting_points[-1])
-                        corresponding_points.append(corresponding_points[-1])
-                        continue
-                    else:
-                        dx, dy = adj_contour[j+2][0] - p1
-
-                perp_vector = ((1/np.linalg.norm([-dy, dx]))*np.array([-dy, dx]))
-                
-                starting_points.append((p1 + self.settings[0]*perp_vector).astype(int))
-                corresponding_points.append((p1 + (self.settings[1] - self.settings[0])*perp_vector).astype(int))
+            # find points to look for color in, on a line perpendicular to the contour at each point
+            points = adj_contour[:edge.points_per_side,0]
+            deltas = points[1:] - points[:-1]
+            repeated = np.all(deltas == 0, axis=1)
+            if len(deltas) > 0 and repeated[0]:
+                deltas[0] = points[2] - points[0]
+            dx, dy = deltas[:,0], deltas[:,1]
+            perp_vectors = (1/np.sqrt(dy*dy + dx*dx))[:,np.newaxis]*np.stack((-dy, dx), axis=1)
+            starting_points = (points[:-1] + self.settings[0]*perp_vectors).astype(int)
+            corresponding_points = (points[:-1] + (self.settings[1] - self.settings[0])*perp_vectors).astype(int)
+            # a point in the same place as the next one uses the points of the one before it
+            repeated[0] = False
+            previous = np.maximum.accumulate(np.where(repeated, 0, np.arange(len(repeated))))
+            starting_points = starting_points[previous]
+            corresponding_points = corresponding_points[previous]
+
+            # area around each quad of points, in the cropped image
+            quads = np.stack((starting_points[1:-2], corresponding_points[1:-2], corresponding_points[3:], starting_points[3:]), axis=1)
+            mins = np.maximum(np.min(quads, axis=1), 0)
+            maxs = np.minimum(np.max(quads, axis=1) + 1, 2*r)
+            hist_indices = set(hist_indices.tolist())
 
             # iterate over points to look for colors in
             for j in range(2, edge.points_per_side-2):
-                p1 = starting_points[j-1]
-                p2 = starting_points[j+1]
-                p3 = corresponding_points[j-1]
-                p4 = corresponding_points[j+1]
-
-                # get the color average
-                edge_mask_2 = np.zeros((2*r, 2*r), dtype=np.uint8)
-                cv2.drawContours(edge_mask_2, [np.array([p1, p3, p4, p2])], -1, 255, thickness=-1)
-
-                edge_mask_2 = cv2.bitwise_and(edge_mask_2, piece_mask)
-                hist_mask = cv2.bitwise_or(hist_mask, edge_mask_2)
-
-                color_avg = cv2.mean(padded_image, mask=edge_mask_2)
-                color = np.array([color_avg[0], color_avg[1], color_avg[2]])
-
-                # # uncomment to make the gif
-                # piece_mask_show[edge_mask_2 > 0] = padded_image[edge_mask_2 > 0]
-                # cv2.imshow('em2', piece_mask_show)
-                # if j % 4 == 0:
-                #     color_images.append(piece_mask_show.copy())
-                # cv2.waitKey(20)
-
-                if edge_colors is None:
-                    edge_colors = color
-                else:
-                    edge_colors = np.vstack((edge_colors, color))
+                quad = quads[j-2]
+                (min_x, min_y), (max_x, max_y) = mins[j-2].tolist(), maxs[j-2].tolist()
+
+                # get the color average, only drawing the area around the quad
+                color = np.zeros(3)
+                if max_x > min_x and max_y > min_y:
+                    box = (slice(min_y, max_y), slice(min_x, max_x))
+                    edge_mask_2 = np.zeros((max_y - min_y, max_x - min_x), dtype=np.uint8)
+                    cv2.drawContours(edge_mask_2, [quad], -1, 255, thickness=-1, offset=(-min_x, -min_y))
+
+                    edge_mask_2 = cv2.bitwise_and(edge_mask_2, piece_mask[box])
+                    hist_mask[box] |= edge_mask_2
+
+                    color_avg = cv2.mean(padded_image[box], mask=edge_mask_2)
+                    color = np.array([color_avg[0], color_avg[1], color_avg[2]])
+
+                edge_colors.append(color)
 
                 # calculate histogram
-                if np.any(hist_indices == j):
-                    hist = cv2.calcHist([padded_image], [0, 1, 2], hist_mask, [16, 16, 16], [0, 256, 0, 256, 0, 256])
+                if j in hist_indices:
+                    hist = np.bincount(hist_bins[hist_mask > 0], minlength=16*16*16).reshape(16, 16, 16).astype(np.float32)
                     cv2.normalize(hist, hist, alpha=0, beta=1, norm_type=cv2.NORM_MINMAX)
                     edge_color_hists.append(hist)
 
-                    hist_mask = np.zeros_like(hist_mask)
+                    hist_mask[:] = 0
 
 
-            edge.color_arr = edge_colors
-            edge.color_hists = edge_color_hists
+            edge.color_arr = np.array(edge_colors)
+            edge.setColorHists(edge_color_hists)
 
         # # uncomment to save the gif
         # for j in range(64):
@@ -466,6 +525,25 @@ def cart2pol(x, y):
     phi = np.arctan2(y, x)
     return rho, phi
 
+# smallest circle around the contour. Found from the convex hull, which has the same circle
+# but far fewer points
+def getEnclosingCircle(contour):
+    return cv2.minEnclosingCircle(cv2.convexHull(contour))
+
+'''
+returns the part of the image around the contour, padded by PATCH_PADDING, as a copy so the rest of
+the image can be released, along with the x, y of the patch in the photo. image_offset is the
+x, y of the image in the photo, if it is just part of it
+'''
+def getPatch(image, contour, image_offset=(0, 0)):
+    h, w, _ = image.shape
+    x, y, cw, ch = cv2.boundingRect(contour)
+    left = max(x - PATCH_PADDING - int(image_offset[0]), 0)
+    top = max(y - PATCH_PADDING - int(image_offset[1]), 0)
+    right = min(x + cw + PATCH_PADDING - int(image_offset[0]), w)
+    bottom = min(y + ch + PATCH_PADDING - int(image_offset[1]), h)
+    patch = image[top:bottom, left:right].copy()
+    return patch, np.array([left + int(image_offset[0]), top + int(image_offset[1])])
 
 def running_average(x, n):
     from scipy.ndimage.filters import uniform_filter1d
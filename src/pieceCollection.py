@@ -1,42 +1,81 @@
-from scipy import stats
 import cv2
 import numpy as np
 import math
 import random
+import queue
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
-from piece import Piece
+from piece import Piece, getPatch
+from edge import Edge, EdgeTable
 '''
 The PieceCollection class stores all pieces. Includes functions to show the pieces
 in order to make sure all the things are calculated correctly.
 '''
 class PieceCollection:
     def __init__(self, settings=[10, 50, 50, 12, 20, 32]):
-        self.images = [] # images passed to the collection
+        self.filenames = [] # images passed to the collection, the pieces only keep the part of the image around them
+        self.image_numbers = [] # index of the image each piece was found in
         self.pieces = [] # pieces stored in the collection
+        self.edge_table = EdgeTable() # metrics of the edges of all the pieces, see Edge
         self.num_pieces_arr = [] # num pieces per image
         self.num_pieces_total = 0
         self.settings = settings
 
     '''
     Adds the pieces found in the image (filename) to the collection
+    num_workers - number of processes to find the corners, edges and colors of the pieces in
+    segment_scale - 2 or 4 to find the pieces on a smaller image first, see getContours
     '''
-    def addPieces(self, filename, num_pieces, color_spec="HSV"):
-        image = cv2.imread(filename)
-        h, w, _ = image.shape
-        print(image.shape)
-
-        # finds the contours and the labels for the pieces in the image
-        contours = getContours(image, num_pieces, self.settings[:3], color_spec=color_spec)
-        # image_glare_removed = removeGlare(contours, image)
-
-        labels = getLabels(contours, len(self.images) + 1)
-        # adds piece objects for each pair to the array of pieces
-        for i, contour in enumerate(contours):
-            label = labels[i]
-            self.pieces.append(Piece(label, len(self.pieces), image, contour, self.settings[3:]))
-
-        # adds the values to the arrays, total
-        self.images.append(image)
+    def addPieces(self, filename, num_pieces, color_spec="HSV", num_workers=1, segment_scale=1):
+        self.addImages([(filename, num_pieces)], color_spec=color_spec, num_workers=num_workers, segment_scale=segment_scale)
+
+    '''
+    Adds the pieces found in each of the images (filename, num_pieces), in order.
+    The next images are read in a thread while the pieces are found in this one, and the corners,
+    edges and colors of the pieces are found by num_workers processes while the next images are
+    segmented, so reading, segmenting and finding the pieces overlap.
+    prefetch_depth - number of images read ahead of the one being segmented, each one is kept in memory
+    '''
+    def addImages(self, image_infos, color_spec="HSV", num_workers=1, segment_scale=1, prefetch_depth=2):
+        # the workers are started from a fork server instead of forked from this process, since the
+        # images are read in a thread (see prefetchImages) that could be holding locks when they start
+        executor = ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context('forkserver')) if num_workers > 1 else None
+        try:
+            found = [] # pieces, or the futures of the pieces being found by the workers, for each image
+            first_number = len(self.pieces)
+            for (filename, num_pieces), image in zip(image_infos, prefetchImages([filename for filename, _ in image_infos], prefetch_depth)):
+                print(image.shape)
+
+                # finds the contours and the labels for the pieces in the image
+                contours = getContours(image, num_pieces, self.settings[:3], color_spec=color_spec, segment_scale=segment_scale)
+                # image_glare_removed = removeGlare(contours, image)
+
+                labels = getLabels(contours, len(self.filenames) + len(found) + 1)
+                if not executor is None and len(contours) > 1:
+                    found.append(submitPieces(executor, image, contours, labels, first_number, self.settings[3:]))
+                else:
+                    # adds piece objects for each pair to the array of pieces
+                    found.append([Piece(label, first_number + i, image, contour, self.settings[3:]) for i, (label, contour) in enumerate(zip(labels, contours))])
+                first_number += len(contours)
+                del image
+
+            # adds the pieces of each image in order, waiting for the workers
+            for (filename, num_pieces), pieces in zip(image_infos, found):
+                self.addFoundPieces(filename, [getFoundPiece(piece) for piece in pieces], num_pieces)
+        finally:
+            if not executor is None:
+                executor.shutdown()
+
+    '''
+    Adds pieces that were already found in the image, e.g. loaded from the cache in puzzleCache
+    '''
+    def addFoundPieces(self, filename, pieces, num_pieces):
+        self.pieces.extend(pieces)
+        self.edge_table.takeEdges([edge for piece in pieces for edge in piece.edges])
+        self.image_numbers.extend([len(self.filenames)] * len(pieces))
+        self.filenames.append(filename)
         self.num_pieces_arr.append(num_pieces)
         self.num_pieces_total += num_pieces
 
@@ -56,7 +95,7 @@ class PieceCollection:
             if piece_image_size > max_size:
                 max_size = piece_image_size
 
-        pieces_image = np.zeros((max_size * h, max_size * w, 3), dtype=self.images[0].dtype)
+        pieces_image = np.zeros((max_size * h, max_size * w, 3), dtype=np.uint8)
         h, w, _ = pieces_image.shape
         index = 0
         for i, num_pieces in enumerate(self.num_pieces_arr):
@@ -78,9 +117,10 @@ class PieceCollection:
     shows all the pieces
     '''
     def showPieceImages(self):
-        for i, image in enumerate(self.images):
+        for i, filename in enumerate(self.filenames):
             print(i)
-            pieces = [piece for piece in self.pieces if piece.image is image]
+            image = cv2.imread(filename)
+            pieces = [piece for piece, image_number in zip(self.pieces, self.image_numbers) if image_number == i]
             contours = [piece.contour for piece in pieces]
             image_pieces = drawPieces(image, f'{i}', contours)
             image_pieces_2 = drawPieces(image, f'{i}', contours)
@@ -136,32 +176,61 @@ def showLabels( img, contours, labels ):
         cv2.putText(img, str(labels[i]), (textX, textY), cv2.FONT_HERSHEY_SIMPLEX, font_size, (0,0,0), font_thickness, 3)
     return img
 
+'''
+finds the most common value of each channel in the image, rounded to a multiple of 5, as the
+background color. Only every step-th row and column is looked at, every other one finds the same
+color on the input photos. The values are packed with their channel so one bincount counts all three channels
+'''
+def getBackgroundColor(image, step=2):
+    colors = image[::step, ::step].reshape(-1, 3)
+    # round to the nearest multiple of 5 (there are 52 of them from 0 to 255), offset by channel
+    codes = (colors.astype(np.int32) + 2) // 5 + np.array([0, 52, 104])
+    counts = np.bincount(codes.ravel(), minlength=3*52).reshape(3, 52)
+    # ties go to the smaller value, same as scipy.stats.mode
+    return 5.0 * np.argmax(counts, axis=1)
+
 '''
 Calculates the contours for the pieces on the image
+segment_scale - 2 or 4 to find the pieces on an image that many times smaller, and then find their
+contours at full size only around their edges, which is faster for big photos. 1 to use the full image
 '''
-def getContours(image, num_pieces, settings, color_spec="HSV"):
+def getContours(image, num_pieces, settings, color_spec="HSV", segment_scale=1):
     color_range = settings
+    if segment_scale > 1:
+        return getContoursPyramid(image, num_pieces, color_range, color_spec, segment_scale)
+
     # convert the image to the given color spectrum
+    image_hsv = convertColor(image, color_spec)
+
+    # find the most common color
+    background = getBackgroundColor(image_hsv)
+
+    return findPieceContours(image_hsv, num_pieces, background, color_range)
+
+'''
+converts the image from BGR to the given color spectrum
+'''
+def convertColor(image, color_spec):
     if color_spec == "HSV":
-        image_hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+        return cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
     elif color_spec == "LAB":
-        image_hsv = cv2.cvtColor(image, cv2.COLOR_BGR2LAB)
+        return cv2.cvtColor(image, cv2.COLOR_BGR2LAB)
     else:
-        image_hsv = image.copy()
-
-    # reshape image into just 3 by num pixels list of the colors
-    colors = image_hsv.reshape(-1, 3)
-    colors = 5 * np.around(colors / 5)
-    # find the most common color in that list
-    background = stats.mode(colors)[0][0]
+        return image.copy()
 
+'''
+finds the contours of the num_pieces biggest pieces in the image, which is scale times smaller
+than the photo. The erosion and dilation are scaled down with it
+'''
+def findPieceContours(image_hsv, num_pieces, background, color_range, scale=1):
     #make a mask based on the most common color
     mins = background - np.array(color_range)
     maxs = background + np.array(color_range)
     mask = cv2.inRange(image_hsv, mins, maxs)
 
     # erode the mask
-    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5,5))
+    erode_size = 2*(2 // scale) + 1
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (erode_size,erode_size))
 
     mask = cv2.erode(mask, kernel, iterations=1)
 
@@ -178,7 +247,7 @@ def getContours(image, num_pieces, settings, color_spec="HSV"):
     kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3,3))
 
     # dilate the mask
-    mask = cv2.dilate(mask, kernel, iterations=5)
+    mask = cv2.dilate(mask, kernel, iterations=max(5 // scale, 1))
 
     #find contours in the mask
     contours, _ = cv2.findContours(mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_NONE)
@@ -190,11 +259,168 @@ def getContours(image, num_pieces, settings, color_spec="HSV"):
 
     return contours
 
+'''
+Calculates the contours for the pieces on the image, finding the pieces on an image scale times smaller.
+Then each contour is found again at full size in a band around the scaled up contour, the same
+way getContours finds it, so the pixels in the rest of the photo are never looked at at full size
+'''
+def getContoursPyramid(image, num_pieces, color_range, color_spec, scale):
+    h, w, _ = image.shape
+    # the background is found from the same pixels as getContours
+    background = getBackgroundColor(convertColor(np.ascontiguousarray(image[::2, ::2]), color_spec), step=1)
+
+    small_image = cv2.resize(image, (w // scale, h // scale), interpolation=cv2.INTER_AREA)
+    small_contours = findPieceContours(convertColor(small_image, color_spec), num_pieces, background, color_range, scale=scale)
+
+    # how far from the scaled up contour the edge of the piece can be, in pixels of the small image
+    band = 4 + 16 // scale
+    contours = []
+    for small_contour in small_contours:
+        contour = refineContour(image, small_contour, background, color_range, color_spec, scale, band)
+        if contour is None:
+            contour = (small_contour * scale + scale // 2).astype(np.int32)
+        contours.append(contour)
+
+    # same order as getContours, which has pieces with the same area in the opposite order they
+    # start in the image
+    return sorted(contours, key=lambda contour: (cv2.contourArea(contour), contour[0,0,1], contour[0,0,0]), reverse=True)
+
+'''
+finds the contour of a piece at full size near its contour in the image that is scale times smaller,
+within band pixels of the small image from it. Pixels further inside are part of the piece and
+further outside are background, and the pixels in between are found the same way as in
+findPieceContours. The band is made wider, up to max_band, if the piece reaches the outside of it.
+Returns None if no piece is found
+'''
+def refineContour(image, small_contour, background, color_range, color_spec, scale, band, max_band=None):
+    if max_band is None:
+        max_band = 4*band
+    h, w, _ = image.shape
+    x, y, cw, ch = cv2.boundingRect(small_contour)
+    # leave room for the band and the erosion around it
+    margin = band + 2
+    x, y, cw, ch = x - margin, y - margin, cw + 2*margin, ch + 2*margin
+
+    # part of the piece that is inside the band, and the part that isn't outside of it, found in the
+    # small image and then scaled up
+    small_mask = np.zeros((ch, cw), dtype=np.uint8)
+    cv2.drawContours(small_mask, [small_contour], -1, 255, thickness=-1, offset=(-x, -y))
+    band_kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2*band+1, 2*band+1))
+    inside = cv2.erode(small_mask, band_kernel, iterations=1)
+    not_outside = cv2.dilate(small_mask, band_kernel, iterations=1)
+    inside = cv2.resize(inside, (cw*scale, ch*scale), interpolation=cv2.INTER_NEAREST)
+    not_outside = cv2.resize(not_outside, (cw*scale, ch*scale), interpolation=cv2.INTER_NEAREST)
+
+    # the roi at full size, cut to the image
+    left, top = max(x*scale, 0), max(y*scale, 0)
+    right, bottom = min((x + cw)*scale, w), min((y + ch)*scale, h)
+    inside = inside[top - y*scale:bottom - y*scale, left - x*scale:right - x*scale]
+    not_outside = not_outside[top - y*scale:bottom - y*scale, left - x*scale:right - x*scale]
+    roi_hsv = convertColor(image[top:bottom, left:right], color_spec)
+
+    # same as findPieceContours at full size, just in the roi
+    mins = background - np.array(color_range)
+    maxs = background + np.array(color_range)
+    mask = cv2.inRange(roi_hsv, mins, maxs)
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5,5))
+    mask = cv2.erode(mask, kernel, iterations=1)
+    piece_mask = cv2.bitwise_or(inside, cv2.bitwise_and(cv2.bitwise_not(mask), not_outside))
+
+    # fill the holes in the piece
+    mask_contours, _ = cv2.findContours(piece_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+    if len(mask_contours) == 0:
+        return None
+    piece_contour = max(mask_contours, key=cv2.contourArea)
+
+    # if the piece goes to the outside of the band, the small image missed part of it, so look further
+    if band < max_band and np.any(cv2.erode(not_outside, None)[piece_contour[:,0,1], piece_contour[:,0,0]] == 0):
+        return refineContour(image, small_contour, background, color_range, color_spec, scale, 2*band, max_band)
+
+    mask_new = np.full_like(mask, 255)
+    mask = cv2.drawContours(mask_new, [piece_contour], -1, color=0, thickness=-1)
+
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3,3))
+
+    # dilate the mask
+    mask = cv2.dilate(mask, kernel, iterations=5)
+
+    # the piece is the biggest hole in the mask
+    contours, hierarchies = cv2.findContours(mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_NONE)
+    contours = [contours[i] for i in range(len(contours)) if hierarchies[0][i][3] >= 0]
+    if len(contours) == 0:
+        return None
+    return max(contours, key=cv2.contourArea) + np.array([left, top], dtype=np.int32)
+
 def getLabels(contours, image_num):
     labels = []
     for i, contour in enumerate(contours):
         labels.append(f'{image_num}: {i}')
     return labels
+
+'''
+reads the images in a thread, yielding them in order. At most depth images are read ahead of the
+one being used, so the thread waits for them to be used before reading more
+'''
+def prefetchImages(filenames, depth=2):
+    images = queue.Queue(maxsize=max(depth, 1))
+    stop = threading.Event()
+
+    def readImages():
+        for filename in filenames:
+            # don't read the rest of the images if they aren't used anymore
+            if stop.is_set():
+                break
+            image = cv2.imread(filename)
+            # wait for space, unless the images aren't used anymore
+            while not stop.is_set():
+                try:
+                    images.put(image, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
+    reader = threading.Thread(target=readImages, daemon=True)
+    reader.start()
+    try:
+        for _ in filenames:
+            yield images.get()
+    finally:
+        stop.set()
+        reader.join()
+
+'''
+starts making the pieces for the contours in the executor's processes. Each process is sent just
+the patch of the image around the piece (see getPatch) and the contour, and sends back the corners
+and the table of the edges it found. Returns a future for each piece, in the same order as the
+contours, numbered from first_number, see getFoundPiece
+'''
+def submitPieces(executor, image, contours, labels, first_number, settings):
+    futures = []
+    for i, (label, contour) in enumerate(zip(labels, contours)):
+        piece_image, offset = getPatch(image, contour)
+        task = (label, piece_image, contour, settings, offset)
+        futures.append((executor.submit(findPieceInWorker, task), task, first_number + i))
+    return futures
+
+'''
+returns the piece, or makes it from the result of a worker process started by submitPieces
+'''
+def getFoundPiece(found):
+    if isinstance(found, Piece):
+        return found
+    future, (label, piece_image, contour, settings, offset), number = found
+    corners, edge_arrays = future.result()
+    edge_table = EdgeTable.fromArrays(edge_arrays)
+    edges = [Edge.fromTable(j, edge_table, j) for j in range(edge_table.num_edges)]
+    return Piece.fromDescriptors(label, number, piece_image, contour, settings, corners, edges, image_offset=offset)
+
+'''
+finds a piece in a worker process, returns its corners and the arrays of the table of its edges
+'''
+def findPieceInWorker(task):
+    label, piece_image, contour, settings, offset = task
+    piece = Piece(label, 0, piece_image, contour, settings, image_offset=offset)
+    return piece.corners, piece.edges[0].table.getArrays()
 if __name__ == '__main__':
 
     # collection = PieceCollection(settings=[20, 40, 50, 16, 26, 64])
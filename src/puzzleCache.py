@@ -0,0 +1,152 @@
+import numpy as np
+import hashlib
+import json
+import os
+import tempfile
+import zipfile
+
+from piece import Piece
+from edge import Edge, EdgeTable, getTableRows
+from edgeMatrix import EdgeScores
+
+# change when the stored descriptors or the way they are found changes, so old caches aren't used
+CACHE_VERSION = 3
+
+# arrays stored in a cache file by saveCache
+CACHE_ARRAYS = ('version', 'num_pieces_arr', 'piece_labels', 'piece_images', 'piece_contour_lengths', 'piece_contours',
+        'piece_corners', 'patch_shapes', 'patch_offsets', 'patches', 'patch_masks', 'edge_labels', 'edge_contours', 'edge_distance_arrs', 'edge_corner_dists', 'edge_color_arrs',
+        'hist_shape', 'hist_fills', 'hist_rows', 'hist_bins', 'hist_values', 'hist_offsets', 'hist_variances', 'raw_metrics', 'complete', 'metric_mins', 'metric_maxs')
+
+'''
+The cache stores the pieces found in a set of images and the raw edge comparisons from EdgeMatrix
+in an .npz file, so running the same puzzle again doesn't have to find the pieces or compare
+the edges again. The file is named by a fingerprint of everything used to find the pieces,
+so changing an image, the number of pieces, the settings, the color spec, the number of shape
+candidates or the segment scale uses a new file.
+'''
+
+'''
+returns the path of the cache file for the given inputs, in cache_dir
+'''
+def getCachePath(cache_dir, image_infos, settings, color_spec, num_shape_candidates=None, segment_scale=1):
+    fingerprint = hashlib.sha256()
+    fingerprint.update(json.dumps([CACHE_VERSION, list(settings), color_spec, num_shape_candidates, segment_scale]).encode())
+    for filename, num_pieces in image_infos:
+        with open(filename, 'rb') as f:
+            fingerprint.update(f.read())
+        fingerprint.update(str(num_pieces).encode())
+    return os.path.join(cache_dir, f'{fingerprint.hexdigest()}.npz')
+
+'''
+saves the pieces in the collection and the raw edge comparisons to the cache file
+'''
+def saveCache(path, collection, edge_scores):
+    pieces = collection.pieces
+    edges = [edge for piece in pieces for edge in piece.edges]
+    table, rows = getTableRows(edges)
+
+    # histograms are mostly empty, so every empty bin of a histogram has the same value in its
+    # normalized vector, which is also the smallest. Only the bins with other values are stored
+    hist_vectors = table.getArray('hist_vectors', rows)
+    hist_values = hist_vectors.reshape(-1, hist_vectors.shape[2])
+    hist_fills = np.min(hist_values, axis=1)
+    hist_rows, hist_bins = np.nonzero(hist_values != hist_fills[:,np.newaxis])
+
+    # the patch of the photo around each piece is stored so the photos don't have to be read again,
+    # with the masks packed into bits
+    patch_shapes = np.array([piece.image.shape[:2] for piece in pieces])
+    patches = np.concatenate([piece.image.reshape(-1) for piece in pieces])
+    patch_masks = np.packbits(np.concatenate([piece.mask.reshape(-1) > 0 for piece in pieces]))
+
+    # written to a temporary file first and moved over path once it's complete, so a run that is
+    # stopped part way through doesn't leave a broken cache file behind
+    cache_dir = os.path.dirname(path) or '.'
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f,
+                version=np.array(CACHE_VERSION),
+                num_pieces_arr=np.array(collection.num_pieces_arr),
+                piece_labels=np.array([piece.label for piece in pieces]),
+                piece_images=np.array(collection.image_numbers),
+                piece_contour_lengths=np.array([len(piece.contour) for piece in pieces]),
+                piece_contours=np.concatenate([piece.contour for piece in pieces]),
+                piece_corners=np.array([piece.corners for piece in pieces]),
+                patch_shapes=patch_shapes,
+                patch_offsets=np.array([piece.image_offset for piece in pieces]),
+                patches=patches,
+                patch_masks=patch_masks,
+                edge_labels=np.array(table.getArray('labels', rows).tolist()),
+                edge_contours=table.getArray('contours', rows),
+                edge_distance_arrs=table.getArray('distance_arrs', rows),
+                edge_corner_dists=table.getArray('corner_dists', rows),
+                edge_color_arrs=table.getArray('color_arrs', rows),
+                hist_shape=np.array(hist_vectors.shape),
+                hist_fills=hist_fills,
+                hist_rows=hist_rows,
+                hist_bins=hist_bins,
+                hist_values=hist_values[hist_rows, hist_bins],
+                hist_offsets=table.getArray('hist_offsets', rows),
+                hist_variances=table.getArray('hist_variances', rows),
+                raw_metrics=edge_scores.raw_metrics,
+                complete=np.array(edge_scores.complete),
+                metric_mins=np.array(edge_scores.mins),
+                metric_maxs=np.array(edge_scores.maxs))
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+'''
+loads the pieces from the cache file into the collection, without reading the images again
+returns the EdgeScores for the pieces, or None if there isn't a usable cache file
+'''
+def loadCache(path, collection, image_infos):
+    if not os.path.exists(path):
+        return None
+    try:
+        with np.load(path) as data:
+            data = {name: data[name] for name in CACHE_ARRAYS}
+    except (OSError, ValueError, EOFError, KeyError, zipfile.BadZipFile) as e:
+        # a broken file would fail the same way every run, so it's removed and made again
+        print(f'could not read cache {path}: {e}')
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return None
+    if int(data['version']) != CACHE_VERSION:
+        return None
+
+    num_edges = len(data['edge_labels'])
+    hist_vectors = np.repeat(data['hist_fills'][:,np.newaxis], data['hist_shape'][2], axis=1)
+    hist_vectors[data['hist_rows'], data['hist_bins']] = data['hist_values']
+
+    edge_table = EdgeTable.fromArrays({'contours': data['edge_contours'], 'distance_arrs': data['edge_distance_arrs'],
+            'labels': np.array(data['edge_labels'].tolist(), dtype=object), 'corner_dists': data['edge_corner_dists'],
+            'color_arrs': data['edge_color_arrs'], 'hist_vectors': hist_vectors.reshape(data['hist_shape']),
+            'hist_offsets': data['hist_offsets'], 'hist_variances': data['hist_variances']})
+
+    contour_starts = np.concatenate(([0], np.cumsum(data['piece_contour_lengths'])))
+    patch_sizes = np.prod(data['patch_shapes'], axis=1)
+    patch_starts = np.concatenate(([0], np.cumsum(patch_sizes)))
+    masks = np.unpackbits(data['patch_masks'], count=patch_starts[-1]).astype(np.uint8) * 255
+    settings = collection.settings[3:]
+    pieces = []
+    for i, label in enumerate(data['piece_labels'].tolist()):
+        edges = [Edge.fromTable(j, edge_table, i*4 + j) for j in range(4)]
+        contour = data['piece_contours'][contour_starts[i]:contour_starts[i + 1]]
+        h, w = data['patch_shapes'][i]
+        image = data['patches'][patch_starts[i]*3:patch_starts[i + 1]*3].reshape(h, w, 3)
+        mask = masks[patch_starts[i]:patch_starts[i + 1]].reshape(h, w)
+        pieces.append(Piece.fromDescriptors(label, i, image, contour, settings, data['piece_corners'][i], edges,
+                image_offset=data['patch_offsets'][i], mask=mask))
+
+    # add the pieces for each image, in the same order they were found
+    for i, ((filename, _), num_pieces) in enumerate(zip(image_infos, data['num_pieces_arr'].tolist())):
+        image_pieces = [piece for piece, image_id in zip(pieces, data['piece_images']) if image_id == i]
+        collection.addFoundPieces(filename, image_pieces, num_pieces)
+
+    return EdgeScores(data['raw_metrics'], num_edges, bounds=(data['metric_mins'].tolist(), data['metric_maxs'].tolist()),
+            complete=bool(data['complete']))
@@ -1,4 +1,5 @@
 from pieceCollection import PieceCollection
+from edge import FLAT, LEFT_FLAT, RIGHT_FLAT, SIGNATURE_MATCHES
 import random
 import cv2
 import numpy as np
@@ -11,17 +12,23 @@ class PuzzleSolution:
     def __init__(self, pieces, dims, dist_dict, sorted_dists, buddy_edges, empty_edge_dist, cutoff):
         self.pieces = pieces # pieceCollection object
         self.puzzle_dims = dims
-        self.dist_dict = dist_dict # distance btw all edges
-        self.sorted_dists = sorted_dists
+        self.dist_dict = dist_dict # distance btw all edges, EdgeDists indexed by edge id
+        self.sorted_dists = sorted_dists # NeighborIndex, closest edge ids for each edge id
         self.buddy_edges = buddy_edges
 
-        self.position_dict = {} # x y coords to piece
+        # the placed pieces are kept in small numpy arrays, indexed by piece number and edge id (hash2),
+        # so that copying a solution is just copying the arrays
+        num_pieces = len(self.pieces.pieces)
+        grid_size = 2 * max(self.puzzle_dims) + 3
+        self.piece_grid = np.full((grid_size, grid_size), -1, dtype=np.int32) # piece number at each y, x coords, -1 if empty
+        self.edge_up_grid = np.zeros((grid_size, grid_size), dtype=np.int8) # edge up of the piece at each y, x coords
+        self.grid_offset = (grid_size // 2, grid_size // 2) # index in the grids of x, y coords 0, 0
+        self.piece_locs = np.zeros((num_pieces, 2), dtype=np.int32) # x y coords of each piece
+        self.piece_edge_ups = np.full(num_pieces, -1, dtype=np.int8) # edge up of each piece, -1 if not placed
         self.left_edge = self.right_edge = self.bottom_edge = self.top_edge = None
-        self.info_dict = {} # piece to x y coords, edge up
 
-        self.all_edges = set()
-        self.all_edges_dict = {}
-        self.edges = set()
+        self.edge_neighbors = np.full(num_pieces * 4, -1, dtype=np.int32) # edge id connected to each edge id, -1 if none
+        self.close_edges = np.zeros(num_pieces * 4, dtype=bool) # if the connection of each edge id is to one of its closest edges
         # self.close_edges = set()
         self.start = None
 
@@ -35,6 +42,7 @@ class PuzzleSolution:
         self.all_piece_dims = [0,0,0,0]
         self.middle_piece_dims = None
         self.side_piece_dims = [None, None]
+        self.valid_placements = {} # (loc, flat dirs) to if a piece can go there, see isValidPlacement
 
         self.randomness_factor = 1
         self.edge_cutoff = max(10, self.pieces.num_pieces_total//4)
@@ -45,16 +53,113 @@ class PuzzleSolution:
     def getDist(self, edge):
         if edge[0] == edge[2]:
             return float('inf')
-        res = self.dist_dict.get(edge) if self.dist_dict.get(edge) else self.dist_dict.get((edge[2], edge[3], edge[0], edge[1]))
+        edge_index1, edge_index2 = hash2(edge[0], edge[1]), hash2(edge[2], edge[3])
+        res = self.dist_dict.getDist(edge_index1, edge_index2)
         if res is None:
-            res = edge[0].edges[edge[1]].compareWeighted(edge[2].edges[edge[3]])
+            # not stored, compare the edges unless it was done recently
+            memo = self.dist_dict.memo
+            if not memo is None:
+                res = memo.get(edge_index1, edge_index2)
+            if res is None:
+                res = edge[0].edges[edge[1]].compareWeighted(edge[2].edges[edge[3]])
+                if not memo is None:
+                    memo.add(edge_index1, edge_index2, res)
         if res is None:
             return float('inf')
         return res
 
+    '''
+    gets the dists btw edge1 on piece1 and each of the edge ids, using getDist for the ones that
+    aren't stored
+    '''
+    def getEdgeDists(self, piece1, edge1, edge_indices):
+        dists = self.dist_dict.getDists(hash2(piece1, edge1), edge_indices)
+        for i in np.nonzero(np.isnan(dists))[0].tolist():
+            edge_index = edge_indices[i]
+            dists[i] = self.getDist((piece1, edge1, self.pieces.pieces[edge_index // 4], edge_index % 4))
+        return dists
+
+    '''
+    puts the piece at x y coords loc with edge_up facing up. The grids are made bigger if needed so
+    there are always 2 cells around the pieces, so the cells next to an empty spot next to a piece
+    can be read without checking the bounds
+    '''
+    def placePiece(self, piece, loc, edge_up):
+        x, y = loc[0] + self.grid_offset[0], loc[1] + self.grid_offset[1]
+        grid_h, grid_w = self.piece_grid.shape
+        if x < 2 or y < 2 or x >= grid_w - 2 or y >= grid_h - 2:
+            pad = max(grid_h, grid_w)
+            self.piece_grid = np.pad(self.piece_grid, pad, constant_values=-1)
+            self.edge_up_grid = np.pad(self.edge_up_grid, pad)
+            self.grid_offset = (self.grid_offset[0] + pad, self.grid_offset[1] + pad)
+            x, y = x + pad, y + pad
+        self.piece_grid[y, x] = piece.number
+        self.edge_up_grid[y, x] = edge_up
+        self.piece_locs[piece.number] = loc
+        self.piece_edge_ups[piece.number] = edge_up
+
+    '''
+    returns the piece at x y coords loc and its edge up, or None if there isn't one
+    '''
+    def getPieceAt(self, loc):
+        x, y = loc[0] + self.grid_offset[0], loc[1] + self.grid_offset[1]
+        grid_h, grid_w = self.piece_grid.shape
+        if x < 0 or y < 0 or x >= grid_w or y >= grid_h:
+            return None
+        number = self.piece_grid.item(y, x)
+        if number < 0:
+            return None
+        return self.pieces.pieces[number], self.edge_up_grid.item(y, x)
+
+    '''
+    returns the x y coords and edge up of a placed piece
+    '''
+    def getLocation(self, piece):
+        return (self.piece_locs.item(piece.number, 0), self.piece_locs.item(piece.number, 1)), self.piece_edge_ups.item(piece.number)
+
+    '''
+    returns the piece and edge connected to edge on piece, or None
+    '''
+    def getConnectedEdge(self, piece, edge):
+        edge_index = self.edge_neighbors.item(hash2(piece, edge))
+        if edge_index < 0:
+            return None
+        return self.pieces.pieces[edge_index // 4], edge_index % 4
+
+    '''
+    returns the connections btw edges in the solution as (piece1, edge1, piece2, edge2), both ways
+    '''
+    def getAllEdges(self):
+        return self.getEdgeTuples(np.flatnonzero(self.edge_neighbors >= 0))
+
+    '''
+    returns the set of connections that are to one of the closest edges, like getAllEdges.
+    If other is given, just the ones that are in both solutions
+    '''
+    def getCloseEdges(self, other=None):
+        close = self.close_edges
+        if not other is None:
+            close = close & other.close_edges & (self.edge_neighbors == other.edge_neighbors)
+        return set(self.getEdgeTuples(np.flatnonzero(close)))
+
+    '''
+    returns a code for each connection btw edges, edge id * number of edges + edge id, both ways
+    '''
+    def getEdgeCodes(self):
+        edge_ids = np.flatnonzero(self.edge_neighbors >= 0)
+        return edge_ids.astype(np.int64) * len(self.edge_neighbors) + self.edge_neighbors[edge_ids]
+
+    '''
+    returns the connections of the edge ids as (piece1, edge1, piece2, edge2)
+    '''
+    def getEdgeTuples(self, edge_ids):
+        pieces = self.pieces.pieces
+        return [(pieces[edge_id // 4], edge_id % 4, pieces[edge_index // 4], edge_index % 4)
+                for edge_id, edge_index in zip(edge_ids.tolist(), self.edge_neighbors[edge_ids].tolist())]
+
     def crossover(self, other, just_sides=False):
-        common_edges = self.edges.intersection(other.edges)
-        # print(len(self.edges), len(other.edges), len(common_edges))
+        common_edges = self.getCloseEdges(other)
+        # print(len(self.getCloseEdges()), len(other.getCloseEdges()), len(common_edges))
         # close_edges = self.close_edges.union(other.close_edges)
         # common_edges.union(close_edges)
         # print(len(common_edges), len(close_edges), len(include_edges))
@@ -75,11 +180,13 @@ class PuzzleSolution:
     def copy(self):
         new_solution = PuzzleSolution(self.pieces, self.puzzle_dims, self.dist_dict, self.sorted_dists, self.buddy_edges, self.empty_edge_dist, cutoff=self.cutoff)
 
-        new_solution.edges = self.edges.copy()
-        new_solution.all_edges = self.all_edges.copy()
-        # new_solution.close_edges = self.close_edges.copy()
-        new_solution.info_dict = self.info_dict.copy()
-        new_solution.position_dict = self.position_dict.copy()
+        new_solution.piece_grid = self.piece_grid.copy()
+        new_solution.edge_up_grid = self.edge_up_grid.copy()
+        new_solution.grid_offset = self.grid_offset
+        new_solution.piece_locs = self.piece_locs.copy()
+        new_solution.piece_edge_ups = self.piece_edge_ups.copy()
+        new_solution.edge_neighbors = self.edge_neighbors.copy()
+        new_solution.close_edges = self.close_edges.copy()
         new_solution.score = self.score
 
         return new_solution
@@ -118,16 +225,14 @@ class PuzzleSolution:
                 self.swapEdges(swap)
                 self.score += swap_cost
 
-                piece1_pos_old, piece1_edge_up_old = self.info_dict[piece1]
-                piece2_pos_old, piece2_edge_up_old = self.info_dict[piece2]
+                piece1_pos_old, piece1_edge_up_old = self.getLocation(piece1)
+                piece2_pos_old, piece2_edge_up_old = self.getLocation(piece2)
                 diff_piece2 = piece2_edge_up_old - edge2
                 diff_piece1 = piece1_edge_up_old - edge1
                 piece1_edge_up_new = (edge1 + diff_piece2) % 4
                 piece2_edge_up_new = (edge2 + diff_piece1) % 4
-                self.info_dict[piece1] = (piece2_pos_old, piece1_edge_up_new)
-                self.info_dict[piece2] = (piece1_pos_old, piece2_edge_up_new)
-                self.position_dict[piece2_pos_old] = (piece1, piece1_edge_up_new)
-                self.position_dict[piece1_pos_old] = (piece2, piece2_edge_up_new)
+                self.placePiece(piece1, piece2_pos_old, piece1_edge_up_new)
+                self.placePiece(piece2, piece1_pos_old, piece2_edge_up_new)
 
                 total_mutation_cost += swap_cost
 
@@ -139,11 +244,11 @@ class PuzzleSolution:
         worst_edges = set()
         side_mutation_chance = 0.2
         if random.uniform(0,1) < side_mutation_chance:
-            allowed_edges = [edge for edge in self.all_edges if edge[0].type in ['side', 'corner'] and edge[2].type in ['side', 'corner']]
+            allowed_edges = [edge for edge in self.getAllEdges() if edge[0].type in ['side', 'corner'] and edge[2].type in ['side', 'corner']]
             allowed_edges = [edge for edge in allowed_edges if not edge in self.mutated_edges]
             num_to_check = min(len(allowed_edges)//4, 32)
         else:
-            allowed_edges = [edge for edge in self.all_edges if not edge in self.mutated_edges]
+            allowed_edges = [edge for edge in self.getAllEdges() if not edge in self.mutated_edges]
             num_to_check = min(len(allowed_edges)//4, 32)
         while len(worst_edges) < min(len(allowed_edges)//4, 32):
             selection = random.sample(allowed_edges, k=num_to_check)
@@ -181,13 +286,13 @@ class PuzzleSolution:
             if (piece1_swap.edges[piece1_edge].label == "flat") ^ (piece2_swap.edges[piece2_edge].label == "flat"):
                 return float('inf'), float('inf'), float('inf')
 
-            entry = self.all_edges_dict.get((piece1_swap, piece1_edge))
+            entry = self.getConnectedEdge(piece1_swap, piece1_edge)
             if not entry is None:
                 piece3, piece3_edge = entry
             else:
                 continue
             
-            entry = self.all_edges_dict.get((piece2_swap, piece2_edge))
+            entry = self.getConnectedEdge(piece2_swap, piece2_edge)
             if not entry is None:
                 piece4, piece4_edge = entry
             else:
@@ -232,21 +337,17 @@ class PuzzleSolution:
         if just_cost_calc:
             return swap_cost, swap_cost_p1, swap_cost_p2
         for edge in remove_edges:
-            self.all_edges.remove(edge)
-            self.all_edges_dict[(edge[0], edge[1])] = None
-            if edge in self.edges:
-                self.edges.remove(edge)
+            self.edge_neighbors[hash2(edge[0], edge[1])] = -1
+            self.close_edges[hash2(edge[0], edge[1])] = False
         for edge in add_edges:
-            self.all_edges.add(edge)
-            self.all_edges_dict[(edge[0], edge[1])] = (edge[2], edge[3])
             dist = self.getDist(edge)
             edge_index = edge[2].number * 4 + edge[3]
             if edge[0].edges[edge[1]].left_neighbor.label == 'flat' or edge[0].edges[edge[1]].right_neighbor.label == 'flat':
                 edge_cutoff = self.edge_cutoff_sides
             else:
                 edge_cutoff = self.edge_cutoff
-            if edge_index in self.sorted_dists[hash2(edge[0], edge[1])][:edge_cutoff]:
-                self.edges.add(edge)
+            self.edge_neighbors[hash2(edge[0], edge[1])] = edge_index
+            self.close_edges[hash2(edge[0], edge[1])] = self.sorted_dists.isClose(hash2(edge[0], edge[1]), edge_index, edge_cutoff)
         return swap_cost, swap_cost_p1, swap_cost_p2
 
     def solvePuzzle(self, random_start=False, show_solve=False, start=None, include_edges=[], do_best_buddies=True, just_sides=False):
@@ -260,15 +361,14 @@ class PuzzleSolution:
             edge1 = random.choice(range(4))
         
         # piece1 at position 0,0 with edge1 up
-        self.position_dict[(0,0)] = (piece1, edge1)
+        self.placePiece(piece1, (0,0), edge1)
 
         self.updateEdges(piece1, (0,0), edge1)
 
         # init helper sets
         remaining_pieces = set(self.pieces.pieces) # available pieces to use
         remaining_pieces.remove(piece1)
-
-        self.info_dict[piece1] = ((0, 0), edge1)
+        remaining_edges = RemainingEdges(self.pieces.pieces, remaining_pieces) # their edges, by which flat edges they're next to
 
         if piece1.type == 'middle':
             self.middle_piece_dims = [0,0,0,0]
@@ -281,6 +381,10 @@ class PuzzleSolution:
         best_buddy_ends = {(edge[0], edge[1]) : (edge[0], edge[1], edge[2], edge[3]) for edge in self.buddy_edges}
         include_starts = set((edge[0], edge[1]) for edge in include_edges)
         include_ends = {(edge[0], edge[1]) : (edge[0], edge[1], edge[2], edge[3]) for edge in include_edges}
+        frontier = {} # best placement found so far off of each kernel edge
+        bounds_state = self.getBoundsState()
+        bounds_version = 0
+        self.valid_placements = {}
 
         for edge in range(4):
             if piece1.edges[edge].label != 'flat':
@@ -309,12 +413,13 @@ class PuzzleSolution:
             if min_dist == float('inf') and do_best_buddies:
                 min_edge, min_adj, min_dist = self.getNextEdgeInclude(self.buddy_edges, best_buddy_num_edges, remaining_pieces, pick_best=False)
             if min_dist == float('inf'):
-                min_edge, min_adj, min_dist = self.getNextEdge(kernel_num_edges, remaining_pieces)
+                min_edge, min_adj, min_dist = self.getNextEdge(kernel_num_edges, remaining_pieces, frontier, bounds_version, remaining_edges)
             if min_dist == float('inf'): # if there are no possible piece locations
                 break
             # get the closest edge
             piece1, edge1, piece2, edge2 = min_edge
             remaining_pieces.remove(piece2) # update available pieces, as piece2 is added to group
+            remaining_edges.remove(piece2)
 
             self.score += min_dist
             
@@ -326,12 +431,12 @@ class PuzzleSolution:
                 else:
                     edge_cutoff = self.edge_cutoff
                 edge_index = edge[2].number * 4 + edge[3]
-                if edge_index in self.sorted_dists[hash2(edge[0], edge[1])][:edge_cutoff]:
-                    self.edges.add(edge)
-                    self.edges.add((edge[2], edge[3], edge[0], edge[1]))
+                if self.sorted_dists.isClose(hash2(edge[0], edge[1]), edge_index, edge_cutoff):
+                    self.close_edges[hash2(edge[0], edge[1])] = True
+                    self.close_edges[edge_index] = True
 
-                self.all_edges.add(edge)
-                self.all_edges.add((edge[2], edge[3], edge[0], edge[1]))
+                self.edge_neighbors[hash2(edge[0], edge[1])] = edge_index
+                self.edge_neighbors[edge_index] = hash2(edge[0], edge[1])
                 if (edge[0], edge[1]) in kernel:
                     kernel.remove((edge[0], edge[1]))
                     for num_adj in range(4):
@@ -343,11 +448,10 @@ class PuzzleSolution:
                             best_buddy_num_edges[num_adj].remove(best_buddy_ends[(edge[0], edge[1])])
 
             # get the location and edge up of piece 2, update info dict, position dict
-            piece1_loc, piece1_edge_up = self.info_dict[piece1]
+            piece1_loc, piece1_edge_up = self.getLocation(piece1)
             piece2_loc, piece2_edge_up = getPieceInfo(piece1, edge1, edge2, piece1_loc, piece1_edge_up)
 
-            self.info_dict[piece2] = (piece2_loc, piece2_edge_up)
-            self.position_dict[piece2_loc] = (piece2, piece2_edge_up)
+            self.placePiece(piece2, piece2_loc, piece2_edge_up)
 
             # add edges that are facing an empty spot to kernel
             for edge in range(4):
@@ -367,7 +471,7 @@ class PuzzleSolution:
                                 if best_buddy_ends.get((adj_piece, adj_edge)) in best_buddy_num_edges[prev_num_adj]:
                                     best_buddy_num_edges[prev_num_adj].remove(best_buddy_ends[(adj_piece, adj_edge)])
 
-                        if self.position_dict.get(new_piece_loc):
+                        if not self.getPieceAt(new_piece_loc) is None:
                             continue
 
                         for adjEdge in adj_edges:
@@ -387,6 +491,12 @@ class PuzzleSolution:
             # get the locations of the left, right, top, and bottom edges of the puzzle if applicable
             self.updateEdges(piece2, piece2_loc, piece2_edge_up)
             self.updatePieceDims(piece2, piece2_loc, piece2_edge_up)
+            # placements found off of the frontier are only rechecked once the bounds change
+            new_bounds_state = self.getBoundsState()
+            if new_bounds_state != bounds_state:
+                bounds_state = new_bounds_state
+                bounds_version += 1
+                self.valid_placements = {}
             if show_solve:
                 image = self.getSolutionImage(with_details=False)
                 h, w, _  = image.shape
@@ -395,9 +505,16 @@ class PuzzleSolution:
                 cv2.imwrite(f'solution{len(remaining_pieces)}.jpg', image)
 
         self.score += 4*len(remaining_pieces)*self.empty_edge_dist
-        self.all_edges_dict = {(edge[0], edge[1]):(edge[2], edge[3]) for edge in self.all_edges}
 
-    def getNextEdge(self, kernel_num_edges, remaining_pieces):
+    '''
+    finds the next piece to add, off of the first edge in kernel_num_edges with the most pieces
+    around its empty spot that has a valid piece to add. frontier keeps the best placement found
+    for each edge (see getBestPlacement) while it can't change, that is until the number of pieces
+    around the spot, the bounds of the puzzle (bounds_version) or the piece it would add changes
+    '''
+    def getNextEdge(self, kernel_num_edges, remaining_pieces, frontier=None, bounds_version=0, remaining_edges=None):
+        if frontier is None:
+            frontier = {}
         min_edge = None
         min_adj = None
         min_dist = float('inf')
@@ -409,43 +526,13 @@ class PuzzleSolution:
                 continue
 
             for piece1, edge1 in kernel_num_adj:
+                entry = frontier.get((piece1, edge1))
+                if entry is None or entry[0] != num_adj or entry[1] != bounds_version or \
+                        (not entry[2][0] is None and not entry[2][0][2] in remaining_pieces):
+                    entry = (num_adj, bounds_version, self.getBestPlacement(piece1, edge1, num_adj, remaining_pieces))
+                    frontier[(piece1, edge1)] = entry
+                min_edge, min_adj, min_dist = entry[2]
 
-                piece1_loc, piece1_edge_up = self.info_dict[piece1]
-
-                for edge_index in self.sorted_dists[hash2(piece1, edge1)]:
-                    piece2 = self.pieces.pieces[edge_index // 4]
-                    if piece2 not in remaining_pieces:
-                        continue
-                    edge2 = edge_index % 4
-                    dist = self.getDist((piece1, edge1, piece2, edge2))
-                    if dist >= min_dist:
-                        break
-
-                    adj_edges, piece2_pos = self.getAdjacentEdges(piece1, edge1, piece2, edge2, piece1_loc, piece1_edge_up)
-                    dist = 0
-                    valid = True
-
-                    for adj_edge in adj_edges:
-                        dist += self.getDist(adj_edge)
-
-                    if dist >= min_dist:
-                        continue
-
-                    for adj_edge in adj_edges:
-                        if not self.isValid(adj_edge[0], adj_edge[1], adj_edge[2], adj_edge[3], piece2_pos[0], piece2_pos[1]):
-                            valid = False
-                            break
-
-                    if not valid:
-                        continue   
-
-                    min_dist = dist
-                    min_edge = (piece1, edge1, piece2, edge2)
-                    min_adj = adj_edges
-
-                    if not min_edge is None and num_adj == 1:
-                        break
-                        
                 if min_dist != float('inf'):
                     break
 
@@ -453,6 +540,9 @@ class PuzzleSolution:
                 break
 
         if min_dist == float('inf'):
+            # none of the closest edges fit, look through every remaining piece that could
+            if remaining_edges is None:
+                remaining_edges = RemainingEdges(self.pieces.pieces, remaining_pieces)
             for num_adj in [4,3,2,1]:
                 kernel_num_adj = kernel_num_edges[num_adj - 1]
 
@@ -460,43 +550,92 @@ class PuzzleSolution:
                     continue
 
                 for piece1, edge1 in kernel_num_adj:
+                    min_edge, min_adj, min_dist = self.getAnyPlacement(piece1, edge1, remaining_edges)
+
+                    if min_dist != float('inf'):
+                        break
 
-                    piece1_loc, piece1_edge_up = self.info_dict[piece1]
+                if min_dist != float('inf'):
+                   break
+        return min_edge, min_adj, min_dist
 
-                    for piece2 in remaining_pieces:
-                        for edge2 in range(4):
-                            dist = self.getDist((piece1, edge1, piece2, edge2))
-                            if dist == float('inf'):
-                                continue
+    '''
+    finds the closest valid piece to add off of edge1 on piece1, going through its closest edges in
+    order. If num_adj is 1, the first valid one is used
+    '''
+    def getBestPlacement(self, piece1, edge1, num_adj, remaining_pieces):
+        min_edge = None
+        min_adj = None
+        min_dist = float('inf')
 
-                            adj_edges, piece2_pos = self.getAdjacentEdges(piece1, edge1, piece2, edge2, piece1_loc, piece1_edge_up)
-                            
-                            dist = 0
-                            valid = True
+        piece1_loc, piece1_edge_up = self.getLocation(piece1)
 
-                            for adj_edge in adj_edges:
-                                dist += self.getDist(adj_edge)
+        for edge_index in self.sorted_dists[hash2(piece1, edge1)].tolist():
+            piece2 = self.pieces.pieces[edge_index // 4]
+            if piece2 not in remaining_pieces:
+                continue
+            edge2 = edge_index % 4
+            dist = self.getDist((piece1, edge1, piece2, edge2))
+            if dist >= min_dist:
+                break
 
-                            for adj_edge in adj_edges:
-                                if not self.isValid(adj_edge[0], adj_edge[1], adj_edge[2], adj_edge[3], piece2_pos[0], piece2_pos[1]):
-                                    valid = False
-                                    break
+            adj_edges, piece2_pos = self.getAdjacentEdges(piece1, edge1, piece2, edge2, piece1_loc, piece1_edge_up)
+            dist = 0
 
-                            if not valid:
-                                continue   
+            for adj_edge in adj_edges:
+                dist += self.getDist(adj_edge)
 
-                            if dist <= min_dist:
-                                min_dist = dist
-                                min_edge = (piece1, edge1, piece2, edge2)
-                                min_adj = adj_edges
+            if dist >= min_dist:
+                continue
 
-                    if min_dist != float('inf'):
-                        break
+            if not self.isValid(piece1, edge1, piece2, edge2, piece2_pos[0], piece2_pos[1]):
+                continue
+
+            min_dist = dist
+            min_edge = (piece1, edge1, piece2, edge2)
+            min_adj = adj_edges
+
+            if num_adj == 1:
+                break
 
-                if min_dist != float('inf'):
-                   break
         return min_edge, min_adj, min_dist
 
+    '''
+    finds the closest valid piece to add off of edge1 on piece1 out of all of the remaining pieces.
+    Only the edges in remaining_edges that fit with edge1 are looked at, their dists to every edge
+    around the empty spot are added up together, and each kind of piece (by where its flat edges
+    would face) is checked with isValidPlacement once for the whole spot
+    '''
+    def getAnyPlacement(self, piece1, edge1, remaining_edges):
+        edge_indices = remaining_edges.getCompatible(piece1, edge1)
+        if len(edge_indices) == 0:
+            return None, None, float('inf')
+
+        piece1_loc, piece1_edge_up = self.getLocation(piece1)
+
+        # the edges around the spot, with the edge piece2 would connect with if edge2 was 0. The
+        # edge it does connect with is just turned by edge2
+        spot_edges, (piece2_loc, edge_up_0) = self.getAdjacentEdges(piece1, edge1, None, 0, piece1_loc, piece1_edge_up)
+        piece_indices = edge_indices - edge_indices % 4
+        dists = np.zeros(len(edge_indices))
+        for piece3, edge3, _, edge2_0 in spot_edges:
+            dists += self.getEdgeDists(piece3, edge3, piece_indices + (edge_indices + edge2_0) % 4)
+
+        flat_dirs = remaining_edges.getFlatDirections(edge_indices, edge_up_0)
+        valid_dirs = np.zeros(16, dtype=bool)
+        for dirs in np.unique(flat_dirs).tolist():
+            valid_dirs[dirs] = self.isValidPlacement(piece2_loc, dirs)
+        dists[~valid_dirs[flat_dirs]] = float('inf')
+
+        i = int(np.argmin(dists))
+        if dists[i] == float('inf'):
+            return None, None, float('inf')
+
+        piece2 = self.pieces.pieces[edge_indices[i] // 4]
+        edge2 = int(edge_indices[i] % 4)
+        adj_edges = [(piece3, edge3, piece2, (edge2_0 + edge2) % 4) for piece3, edge3, _, edge2_0 in spot_edges]
+        return (piece1, edge1, piece2, edge2), adj_edges, float(dists[i])
+
     def getNextEdgeInclude(self, edges_to_include, include_num_edges, remaining_pieces, pick_best=True):
         min_edge = None
         min_adj = None
@@ -512,7 +651,7 @@ class PuzzleSolution:
                     include_num_edges[num_adj - 1].remove((piece1, edge1, piece2, edge2))
                     continue
                 
-                piece1_loc, piece1_edge_up = self.info_dict[piece1]
+                piece1_loc, piece1_edge_up = self.getLocation(piece1)
 
                 adj_edges, piece2_pos = self.getAdjacentEdges(piece1, edge1, piece2, edge2, piece1_loc, piece1_edge_up)
 
@@ -526,13 +665,7 @@ class PuzzleSolution:
                     include_num_edges[num_adj - 1].remove((piece1, edge1, piece2, edge2))
                     continue
 
-                valid = True
-                for adj_edge in adj_edges:
-                    if not self.isValid(adj_edge[0], adj_edge[1], adj_edge[2], adj_edge[3], piece2_pos[0], piece2_pos[1]):
-                        valid = False
-                        break
-
-                if not valid:
+                if not self.isValid(piece1, edge1, piece2, edge2, piece2_pos[0], piece2_pos[1]):
                     include_num_edges[num_adj - 1].remove((piece1, edge1, piece2, edge2))
                     continue
 
@@ -554,17 +687,17 @@ class PuzzleSolution:
         
         # get the info for the pieces
         piece2_loc, piece2_edge_up = getPieceInfo(piece1, edge1, edge2, piece1_loc, piece1_edge_up)
+        x, y = piece2_loc[0] + self.grid_offset[0], piece2_loc[1] + self.grid_offset[1]
 
         # look in each direction
         directions = [(0,-1), (1,0), (0,1), (-1,0)]
         for i, d in enumerate(directions):
             # find the location of this piece, check if anything there
-            piece3_loc = (piece2_loc[0] + d[0], piece2_loc[1] + d[1])
-            entry = self.position_dict.get(piece3_loc)
-            if entry is None:
+            number = self.piece_grid.item(y + d[1], x + d[0])
+            if number < 0:
                 continue
             # get the edge up, piece location of this other piece
-            piece3, piece3_edge_up = entry
+            piece3, piece3_edge_up = self.pieces.pieces[number], self.edge_up_grid.item(y + d[1], x + d[0])
             # find the edges that would connect between the pieces
             if i == 0: # up
                 edge2_2 = piece2_edge_up
@@ -583,6 +716,11 @@ class PuzzleSolution:
 
         return edges, (piece2_loc, piece2_edge_up)
 
+    # everything isValid looks at besides the grid itself
+    def getBoundsState(self):
+        return (self.all_piece_dims, self.middle_piece_dims, tuple(self.side_piece_dims),
+                self.left_edge, self.right_edge, self.top_edge, self.bottom_edge)
+
     # checks if the piece will make any changes to the existing known sides of the puzzle
     def updateEdges(self, piece, piece_loc, piece_edge_up):
         if not piece is None and (piece.type == 'side' or piece.type == 'corner'):
@@ -692,12 +830,28 @@ class PuzzleSolution:
 
     # checks if a piece would break any rules of a consistent, correctly put together puzzle if it were added
     def isValid(self, piece1, edge1, piece2, edge2, piece2_loc, piece2_edge_up, debug=False):
-
-        if self.position_dict.get(piece2_loc):
+        return self.isValidPlacement(piece2_loc, getFlatDirections(piece2, piece2_edge_up), debug)
+
+    '''
+    checks if a piece with its flat edges facing flat_dirs (see getFlatDirections) can go at piece2_loc.
+    Other than the spot being empty, this only depends on the bounds from updateEdges and
+    updatePieceDims, so the results are kept in valid_placements until solvePuzzle sees them change
+    '''
+    def isValidPlacement(self, piece2_loc, flat_dirs, debug=False):
+        if not self.getPieceAt(piece2_loc) is None:
             if debug:
                 print(self.all_piece_dims, '1')
             return False
 
+        valid = self.valid_placements.get((piece2_loc, flat_dirs))
+        if valid is None or debug:
+            valid = self.checkPlacement(piece2_loc, flat_dirs, debug)
+            self.valid_placements[(piece2_loc, flat_dirs)] = valid
+        return valid
+
+    def checkPlacement(self, piece2_loc, flat_dirs, debug=False):
+        piece_type = getPieceType(flat_dirs)
+
         # find width, height with and without the piece
         min_x, max_x, min_y, max_y = self.all_piece_dims
 
@@ -712,14 +866,14 @@ class PuzzleSolution:
         width = max_x_with - min_x_with + 1
         height = max_y_with - min_y_with + 1
 
-        if piece2.type == 'side':
+        if piece_type == 'side':
 
             if not self.side_piece_dims[0] is None and not self.side_piece_dims[1] is None:
                 hor_sides_min, hor_sides_max = self.side_piece_dims[0]
                 vert_sides_min, vert_sides_max = self.side_piece_dims[1]
 
 
-                if piece2.edges[piece2_edge_up].label == 'flat' or piece2.edges[(piece2_edge_up + 2) % 4].label == 'flat':
+                if flat_dirs & 0b0101: # flat edge up or down
                     hor_sides_min = min(hor_sides_min, piece2_loc[0])
                     hor_sides_max = max(hor_sides_max, piece2_loc[0])
                 else:                         
@@ -747,7 +901,7 @@ class PuzzleSolution:
             middle_width = max_x_middle - min_x_middle + 1
             middle_height = max_y_middle - min_y_middle + 1
 
-            if piece2.type == 'middle':
+            if piece_type == 'middle':
                 # update middle width if this piece extends current bounds
                 if piece2_loc[0] < min_x_middle:
                     middle_width += 1
@@ -808,7 +962,7 @@ class PuzzleSolution:
         else:
             middle_width = middle_height = 0
 
-        if piece2.type == 'side' or piece2.type == 'corner':
+        if piece_type == 'side' or piece_type == 'corner':
             # once again, if width, height too big, bad
             if max(width, height) > max(self.puzzle_dims):
                     if debug:
@@ -821,9 +975,8 @@ class PuzzleSolution:
                     return False
 
             # check each edge and find the flat one(s)
-            for i, edge in enumerate(piece2.edges):
-                if edge.label == 'flat':
-                    orientation = (i - piece2_edge_up) % 4
+            for orientation in range(4):
+                if flat_dirs >> orientation & 1:
                     if orientation == 0: # up
                         # first, looking at the top of the puzzle. If there is one, side goes up, it must line up
                         if not self.top_edge is None:
@@ -857,7 +1010,7 @@ class PuzzleSolution:
                                     print(self.all_piece_dims, '18')
                                 return False
                         # not for corner pieces
-                        if piece2.type == 'side':
+                        if piece_type == 'side':
                             # side pieces pointing up can't be on the left / right side of the puzzle. Corner pieces go there.
                             if self.right_edge == piece2_loc[0]:
                                 if debug:
@@ -926,7 +1079,7 @@ class PuzzleSolution:
                                 if debug:
                                     print(self.all_piece_dims, '31')
                                 return False
-                        if piece2.type == 'side':
+                        if piece_type == 'side':
                             if self.bottom_edge == piece2_loc[1]:
                                 if debug:
                                     print(self.all_piece_dims, '32')
@@ -992,7 +1145,7 @@ class PuzzleSolution:
                                 if debug:
                                     print(self.all_piece_dims, '44')
                                 return False
-                        if piece2.type == 'side':
+                        if piece_type == 'side':
                             if self.right_edge == piece2_loc[0]:
                                 if debug:
                                     print(self.all_piece_dims, '45')
@@ -1058,7 +1211,7 @@ class PuzzleSolution:
                                 if debug:
                                     print(self.all_piece_dims, '57')
                                 return False
-                        if piece2.type == 'side':
+                        if piece_type == 'side':
                             if self.bottom_edge == piece2_loc[1]:
                                 if debug:
                                     print(self.all_piece_dims, '58')
@@ -1101,7 +1254,7 @@ class PuzzleSolution:
     def splicePartialSolutionImages(self, solution_image, img1, img2, corners1, corners2, midpoint, direction, c2_in_solution=False, with_details=False, desired_corner=None, resize_factor=0.8):
 
         # assumed that corners1 coords < corners2 in the final image along one of the axis
-        entry = self.position_dict.get(midpoint)
+        entry = self.getPieceAt(midpoint)
         if entry is None:
             return solution_image, corners1, corners2
 
@@ -1190,7 +1343,7 @@ class PuzzleSolution:
                 solution_image[y_coord:y_coord + ph, x_coord:x_coord + pw] = cv2.bitwise_xor(solution_image_section, img2)
 
         for pt_index, pt in enumerate(piece_indices):
-            piece, edge_up = self.position_dict.get(pt)
+            piece, edge_up = self.getPieceAt(pt)
 
             if direction == 1 or direction == 2:
                 index = len(corners1[e1]) - (pt_index + 1)
@@ -1246,17 +1399,14 @@ class PuzzleSolution:
     # returns an image containing the solution to the puzzle
     def getSolutionImage(self, with_details=False, draw_edges=[], resize_factor=0.8, just_sides=False):
         # get the bounds of the solution
-        keys = self.position_dict.keys()
-        min_x = min(keys, key=lambda x:x[0])[0]
-        max_x = max(keys, key=lambda x:x[0])[0]
-
-        min_y = min(keys, key=lambda x:x[1])[1]
-        max_y = max(keys, key=lambda x:x[1])[1]
+        placed = np.flatnonzero(self.piece_edge_ups >= 0)
+        min_x, min_y = np.min(self.piece_locs[placed], axis=0).tolist()
+        max_x, max_y = np.max(self.piece_locs[placed], axis=0).tolist()
 
         # get the subimages for each piece in the solution facing the appropriate direction
         max_size = 0
-        for key in keys:
-            piece, edge_up = self.position_dict[key]
+        for number in placed:
+            piece, edge_up = self.pieces.pieces[number], int(self.piece_edge_ups[number])
             piece_image, _ = piece.getSubimage2(edge_up, with_details=with_details, resize_factor=resize_factor)
 
             piece_image_size = max(piece_image.shape)
@@ -1384,7 +1534,7 @@ class PuzzleSolution:
                         corners[x+1][y] = new_c2
 
                         middle_piece_loc = (x_midpoints[x+1], y_midpoints[y])
-                        entry = self.position_dict.get(middle_piece_loc)
+                        entry = self.getPieceAt(middle_piece_loc)
                         if entry is None:
                             continue
                         middle_piece, edge_up = entry
@@ -1519,7 +1669,7 @@ class PuzzleSolution:
             left_corner_poses = curr_left_corner_poses.copy()
             curr_left_corner_poses = {y:None for y in range(min_y, max_y+1)}
             for y in y_range:
-                entry = self.position_dict.get((x, y))
+                entry = self.getPieceAt((x, y))
                 if entry is None:
                     above_corners = None
                     continue
@@ -1697,6 +1847,75 @@ class ListDict(object):
     def random_choice(self):
         return random.choice(self.list)
 
+'''
+The RemainingEdges class keeps the edges of the pieces that haven't been placed yet, in buckets by
+their signature (see Edge.findSignature). An edge can only be connected to the edges in the buckets
+whose signature matches its own in SIGNATURE_MATCHES, so only those have to be looked at
+'''
+class RemainingEdges:
+    def __init__(self, pieces, remaining_pieces):
+        self.remaining = np.zeros(len(pieces), dtype=bool) # if each piece number hasn't been placed
+        for piece in remaining_pieces:
+            self.remaining[piece.number] = True
+
+        signatures = np.array([edge.signature for piece in pieces for edge in piece.edges], dtype=np.int64)
+        self.flat = (signatures & FLAT != 0).reshape(-1, 4) # if each edge of each piece number is flat
+        # signature to the edge ids with it
+        self.buckets = {signature : np.nonzero(signatures == signature)[0] for signature in np.unique(signatures).tolist()}
+
+    def remove(self, piece):
+        self.remaining[piece.number] = False
+
+    '''
+    returns getFlatDirections for the piece of each edge id, turned the way it would be if that edge
+    was the one connected. edge_up_0 is the edge up it would have if that edge was edge 0
+    '''
+    def getFlatDirections(self, edge_indices, edge_up_0):
+        piece_numbers = edge_indices // 4
+        edge_ups = (edge_indices + edge_up_0) % 4
+        flat_dirs = np.zeros(len(edge_indices), dtype=np.int64)
+        for direction in range(4):
+            flat_dirs |= self.flat[piece_numbers, (edge_ups + direction) % 4].astype(np.int64) << direction
+        return flat_dirs
+
+    '''
+    returns the edge ids of the remaining pieces that can be connected to edge on piece, in order
+    '''
+    def getCompatible(self, piece, edge):
+        signature = piece.edges[edge].signature
+        buckets = [edge_indices for other, edge_indices in self.buckets.items() if SIGNATURE_MATCHES.item(signature, other)]
+        if len(buckets) == 0:
+            return np.zeros(0, dtype=np.int64)
+        edge_indices = np.sort(np.concatenate(buckets)) if len(buckets) > 1 else buckets[0]
+        return edge_indices[self.remaining[edge_indices // 4]]
+
+'''
+returns which directions the flat edges of piece face when edge_up is facing up, as bits of an int
+(1 up, 2 right, 4 down, 8 left). The signature of the edge up has all but the one facing down
+'''
+def getFlatDirections(piece, edge_up):
+    up = piece.edges[edge_up].signature
+    down = piece.edges[(edge_up + 2) % 4].signature
+    flat_dirs = 0
+    if up & FLAT:
+        flat_dirs |= 1
+    if up & RIGHT_FLAT:
+        flat_dirs |= 2
+    if down & FLAT:
+        flat_dirs |= 4
+    if up & LEFT_FLAT:
+        flat_dirs |= 8
+    return flat_dirs
+
+# type of piece from the number of flat edges, same as Piece.findType
+def getPieceType(flat_dirs):
+    num_flat = bin(flat_dirs).count('1')
+    if num_flat == 0:
+        return 'middle'
+    elif num_flat == 1:
+        return 'side'
+    return 'corner'
+
 def hash2(piece1, edge1):
     return piece1.number * 4 + edge1
 
@@ -1,5 +1,8 @@
 from puzzleSolution import PuzzleSolution
 from pieceCollection import PieceCollection
+from edgeMatrix import EdgeMatrix, EdgeScores, EdgeDists, SparseEdgeDists, DistMemo, NeighborIndex, getCandidateRecall
+from puzzleCache import getCachePath, loadCache, saveCache
+from edge import groupByTable
 import random
 import cv2
 import numpy as np
@@ -8,6 +11,7 @@ import math
 import copy
 import sys
 import gc
+import os
 from compressed_dictionary import CompressedDictionary as cdict
 
 
@@ -146,24 +150,54 @@ has an option to do sides first, where the sides of the puzzle are solved and th
 used in future solutions
 '''
 class PuzzleSolver:
-    def __init__(self, puzzle_name, dims, num_gens, gen_size, image_infos, show_sols=True, settings=[10, 50, 50, 20, 30, 64], color_spec="HSV", sides_first=False):
+    def __init__(self, puzzle_name, dims, num_gens, gen_size, image_infos, show_sols=True, settings=[10, 50, 50, 20, 30, 64], color_spec="HSV", sides_first=False, num_workers=1, cache_dir='cache', num_shape_candidates=None,
+            dists_dir=None, dists_dtype='float32', memo_size=100000, segment_scale=1, prefetch_depth=2):
         
-        # toJSON(puzzle_name, dims, num_gens, gen_size, image_infos, show_sols=True, settings=[10, 50, 50, 20, 30, 64], color_spec="HSV", sides_first=False)
+        # toJSON(puzzle_name, dims, num_gens, gen_size, image_infos, show_sols=True, settings=[10, 50, 50, 20, 30, 64], color_spec="HSV", sides_first=False, num_workers=num_workers, num_shape_candidates=num_shape_candidates, dists_dir=dists_dir, dists_dtype=dists_dtype, memo_size=memo_size, segment_scale=segment_scale, prefetch_depth=prefetch_depth)
         # return 
         
         self.side_gen_size = 500 # if doing sides first
         self.side_gens = 500
         
         self.puzzle_name = puzzle_name
+        self.dims = dims
         self.num_gens = num_gens
         self.gen_size = gen_size
         self.total_time = 0
         self.sides_first = sides_first
+        self.num_workers = num_workers # number of processes used to find the pieces and compare edges
+        # if set, only compare each edge to this many edges with the closest shape, for very big puzzles
+        # use reportShapeCandidateRecall to choose it
+        self.num_shape_candidates = num_shape_candidates
+        # if set, the edge comparisons and dists are kept in memory mapped files in this directory
+        # instead of in memory, for puzzles too big for them to fit. dists_dtype can be 'float16'
+        self.dists_dir = dists_dir
+        self.dists_dtype = np.dtype(dists_dtype)
+        if not dists_dir is None:
+            os.makedirs(dists_dir, exist_ok=True)
+        # how many dists that aren't stored to remember after comparing the edges, 0 to not remember any
+        self.memo_size = memo_size
+        # 2 or 4 to find the pieces on a smaller image first and then their contours at full size, for big photos
+        self.segment_scale = segment_scale
+        # number of images read ahead while the pieces are found in the others, each one is kept in memory
+        self.prefetch_depth = prefetch_depth
 
         self.collection = PieceCollection(settings)
-        # add pieces to collection
-        for filename, num_pieces in image_infos:
-            self.collection.addPieces(filename, num_pieces, color_spec=color_spec)
+        # load the pieces and edge comparisons from the cache if these images were already used
+        # with the same settings, cache_dir=None to always find them again
+        # the inputs are kept so the cache can be written again when images are added
+        self.cache_dir = cache_dir
+        self.image_infos = list(image_infos)
+        self.color_spec = color_spec
+        self.cache_path = None
+        self.edge_scores = None
+        if not cache_dir is None:
+            self.cache_path = getCachePath(cache_dir, self.image_infos, settings, color_spec, num_shape_candidates, segment_scale)
+            self.edge_scores = loadCache(self.cache_path, self.collection, image_infos)
+        if self.edge_scores is None:
+            # add pieces to collection
+            self.collection.addImages(image_infos, color_spec=color_spec, num_workers=self.num_workers,
+                    segment_scale=self.segment_scale, prefetch_depth=self.prefetch_depth)
         
         # number of generations done so far
         self.generation_counter = 0
@@ -180,8 +214,6 @@ class PuzzleSolver:
         self.selection_size = min(self.gen_size//2, 100) # how many solutions to select from each generation
 
 
-        self.edge_count_dict = {}  # used in calculating similarity score
-
         self.solutions = []
         self.best_solution = None
 
@@ -194,7 +226,7 @@ class PuzzleSolver:
         # if doing sides first
         if self.sides_first:
             self.solvePuzzleSides()
-            self.solved_sides = self.best_solution.edges.copy()
+            self.solved_sides = self.best_solution.getCloseEdges()
             self.solutions = []
             self.best_solution = None
         
@@ -208,14 +240,81 @@ class PuzzleSolver:
         #                   different from weight color bc this uses a color histogram and has more info
         # weight length diff - how much should the difference in lengths between corners of the edge affect the score
         # num_edges_to_include - how many edges to save in sorted order, greater = more memory use
+        # side_num_edges_to_include - same as num_edges_to_include, for edges next to a flat edge
         # save_all_dists - turn to False to calculate non-sorted dists as the solver goes. False = slow but low memory usage
 
 
+        # compare all the edges once, the weights can be changed after without comparing again
+        if self.edge_scores is None:
+            self.edge_scores = getEdgeScores(self.collection.pieces, num_workers=self.num_workers,
+                    num_shape_candidates=self.num_shape_candidates, raw_metrics_path=self.getDistsPath('raw_metrics.bin'))
+            if not self.cache_path is None:
+                saveCache(self.cache_path, self.collection, self.edge_scores)
+        self.setWeights(weight_dist=3, weight_color=2, weight_color_hist=1, weight_length_diff=3)
+
+    '''
+    Finds the distances between edges using the given weights for each metric.
+    Uses the edge comparisons done in the constructor, so nothing is compared again
+    '''
+    def setWeights(self, weight_dist, weight_color, weight_color_hist, weight_length_diff, num_edges_to_include=200, side_num_edges_to_include=200):
+        # kept so the dists can be updated the same way when pieces are added
+        self.weights = [weight_dist, weight_color, weight_color_hist, weight_length_diff]
+        self.num_edges_to_include = num_edges_to_include
+        self.side_num_edges_to_include = side_num_edges_to_include
         self.dist_dict, self.sorted_dists, self.buddy_edges, self.empty_edge_dist, self.cutoff = getDistDict(self.collection.pieces,
-                weight_dist=3, weight_color=2, weight_color_hist=1, weight_length_diff=3, num_edges_to_include=200, store_all_dists=True)
+                weight_dist=weight_dist, weight_color=weight_color, weight_color_hist=weight_color_hist, weight_length_diff=weight_length_diff,
+                num_edges_to_include=num_edges_to_include, store_all_dists=True, edge_scores=self.edge_scores, num_workers=self.num_workers,
+                side_num_edges_to_include=side_num_edges_to_include, dists_path=self.getDistsPath('dists.npy'), dists_dtype=self.dists_dtype,
+                memo_size=self.memo_size)
 
         gc.collect()
 
+    '''
+    Adds the pieces in another image of the same puzzle, e.g. when the pieces are photographed in
+    batches. Only the new edges are compared, with each other and with the edges already found,
+    and the dists and closest edges are updated with them instead of being found again
+    '''
+    def addImage(self, filename, num_pieces, color_spec="HSV"):
+        first_new_piece = len(self.collection.pieces)
+        self.collection.addPieces(filename, num_pieces, color_spec=color_spec, num_workers=self.num_workers,
+                segment_scale=self.segment_scale)
+        self.max_exp = max(1, len(self.collection.pieces) // 50)
+        # the new pieces can change the shape of the puzzle
+        self.puzzle_dims = getPuzzleDims(self.dims, self.collection.num_pieces_total)
+
+        self.dist_dict, self.sorted_dists, self.buddy_edges, self.empty_edge_dist, self.cutoff = addToDistDict(self.collection.pieces,
+                first_new_piece, self.edge_scores, self.dist_dict, self.sorted_dists, self.empty_edge_dist, self.weights,
+                num_edges_to_include=self.num_edges_to_include, side_num_edges_to_include=self.side_num_edges_to_include,
+                num_workers=self.num_workers, num_shape_candidates=self.num_shape_candidates)
+        self.image_infos.append((filename, num_pieces))
+        self.updateCache(color_spec)
+
+        gc.collect()
+
+    '''
+    moves the cache file to the one for the images used now, after an image is added, so the old
+    file isn't loaded without the new pieces. If the new image used a different color spec than the
+    others there's no file for both, so the old one is only removed
+    '''
+    def updateCache(self, color_spec):
+        if self.cache_path is None:
+            return
+        if os.path.exists(self.cache_path):
+            os.remove(self.cache_path)
+        self.cache_path = None
+        if color_spec == self.color_spec:
+            self.cache_path = getCachePath(self.cache_dir, self.image_infos, self.collection.settings, self.color_spec,
+                    self.num_shape_candidates, self.segment_scale)
+            saveCache(self.cache_path, self.collection, self.edge_scores)
+
+    '''
+    returns the path of a memory mapped file for this puzzle in dists_dir, or None if not using them
+    '''
+    def getDistsPath(self, name):
+        if self.dists_dir is None:
+            return None
+        return os.path.join(self.dists_dir, f'{self.puzzle_name}_{name}')
+
     '''
     Solves the puzzle with just the sides. Gives a lot less information so can be
     hard for it to solve the sides, but if it gets them close can help a lot with the
@@ -228,7 +327,8 @@ class PuzzleSolver:
             piece.number = i
         self.dist_dict, self.sorted_dists, self.buddy_edges, self.empty_edge_dist, self.cutoff = \
             getDistDict(self.side_collection.pieces, \
-            weight_dist=3, weight_color=2, weight_color_hist=1, weight_length_diff=3, num_edges_to_include=50, store_all_dists=True)
+            weight_dist=3, weight_color=2, weight_color_hist=1, weight_length_diff=3, num_edges_to_include=50, store_all_dists=True, num_workers=self.num_workers,
+            memo_size=self.memo_size)
         
         prev_max_exp = self.max_exp
         prev_gen_size = self.gen_size
@@ -406,6 +506,8 @@ class PuzzleSolver:
         end = timer()
         gen_time = (end - start)
         print(f'total time gen {self.generation_counter}: {gen_time}')
+        if not self.dist_dict.memo is None:
+            print(self.dist_dict.memo.getStats())
 
         scores = [solution.score for solution in self.solutions]
         scores2 = sorted(list(set(scores)))
@@ -413,7 +515,7 @@ class PuzzleSolver:
             [solution.similarity_score for solution in self.solutions])
 
         print(
-            f'solution len edges: {[len(solution.edges) for solution in self.solutions[:10]]}')
+            f'solution len edges: {[int(np.count_nonzero(solution.close_edges)) for solution in self.solutions[:10]]}')
         print(
             f'best score gen {self.generation_counter} : {self.best_solution.score}')
         print(
@@ -517,22 +619,15 @@ class PuzzleSolver:
 
     def updateSimilarityScore(self, solvers, include):
 
-        self.edge_count_dict = {}
-        for solver in include:
-            for edge in solver.all_edges:
-                count = self.edge_count_dict.get(edge)
-                if count is None:
-                    count = 0
-                self.edge_count_dict[edge] = count + 1
+        # number of the included solutions that have each edge, by the codes from PuzzleSolution.getEdgeCodes
+        edge_codes, edge_counts = np.unique(np.concatenate([solver.getEdgeCodes() for solver in include]), return_counts=True)
 
         for solver in solvers:
-            solver.similarity_score = 0
-            for edge in solver.all_edges:
-                num_edges = self.edge_count_dict.get(edge)
-                if num_edges is None:
-                    continue
-                solver.similarity_score += num_edges
-            solver.similarity_score /= (len(include) * max(1, len(solver.all_edges)))
+            codes = solver.getEdgeCodes()
+            positions = np.minimum(np.searchsorted(edge_codes, codes), max(len(edge_codes) - 1, 0))
+            found = edge_codes[positions] == codes if len(edge_codes) > 0 else np.zeros(len(codes), dtype=bool)
+            solver.similarity_score = int(np.sum(edge_counts[positions[found]]))
+            solver.similarity_score /= (len(include) * max(1, len(codes)))
         # if an edge was in every single solution in every generation, then it would add 1 to the diversity score
         # if an edge was in NO others then it would add 1/(gen_size*(gen_counter + 1)) to the total
 
@@ -596,47 +691,64 @@ def getPuzzleDims(size_inches, num_pieces):
     return predict_h, predict_w
 
 
-# returns a dict containing the distances between all edges
-def getDistDict(pieces, weight_dist=100, weight_color=100, weight_color_hist=100, weight_length_diff=100, num_edges_to_include=50, store_all_dists=True):
-
-    dist_dict = {}
-    max_dist_diff = 0
-    min_dist_diff = float('inf')
-    max_color_diff = 0
-    min_color_diff = float('inf')
-    max_color_diff_hist = 0
-    min_color_diff_hist = float('inf')
-    max_corner_diff = 0
-    min_corner_diff = float('inf')
+'''
+compares every valid pair of edges once, returns an EdgeScores object holding the raw
+metrics. Can be passed to getDistDict to try new weights without comparing the edges again
+num_workers - number of processes to split the comparisons between, 1 = compare in this process
+num_shape_candidates - if set, only compare each edge to the edges with the closest shapes
+raw_metrics_path - if set, the comparisons are written to this file and read from it as needed
+'''
+def getEdgeScores(pieces, num_workers=1, num_shape_candidates=None, raw_metrics_path=None):
     print('initial dists\n')
 
-    for i, piece1 in enumerate(pieces):
-        print(piece1.label, end=' ', flush=True)
-        for j, piece2 in enumerate(pieces[i+1:]):
-            if piece1 == piece2:
-                continue
-            for edge1 in range(4):
-                for edge2 in range(4):
-                    dist = piece1.edges[edge1].compare(piece2.edges[edge2])
-                    if dist is None:
-                        continue
-                    dist_diff, color_diff, color_diff_hist, corner_diff = dist
-                    if dist_diff > max_dist_diff:
-                        max_dist_diff = dist_diff
-                    if dist_diff < min_dist_diff:
-                        min_dist_diff = dist_diff
-                    if color_diff > max_color_diff:
-                        max_color_diff = color_diff
-                    if color_diff < min_color_diff:
-                        min_color_diff = color_diff
-                    if color_diff_hist > max_color_diff_hist:
-                        max_color_diff_hist = color_diff_hist
-                    if color_diff_hist < min_color_diff_hist:
-                        min_color_diff_hist = color_diff_hist
-                    if corner_diff > max_corner_diff:
-                        max_corner_diff = corner_diff
-                    if corner_diff < min_corner_diff:
-                        min_corner_diff = corner_diff
+    # stack the edge metrics so that blocks of edge pairs can be compared at once
+    edge_matrix = EdgeMatrix(pieces)
+    candidates = None
+    if not num_shape_candidates is None:
+        candidates = edge_matrix.getShapeCandidates(num_shape_candidates)
+        print(f'comparing {len(candidates[0])} pairs with similar shapes\n')
+    raw_metrics, bounds = edge_matrix.getRawMetrics(progress=lambda rows: print(pieces[rows[0] // 4].label, end=' ', flush=True),
+            num_workers=num_workers, candidates=candidates, path=raw_metrics_path)
+    return EdgeScores(raw_metrics, edge_matrix.num_edges, bounds=bounds, complete=candidates is None)
+
+'''
+prints how many of the closest edges to each edge would be kept by the shape prefilter used when
+num_shape_candidates is set, for each number of candidates in candidate_counts. The closest edges
+are found by comparing every pair, so this is slow for big puzzles, but can be run on a smaller
+puzzle with similar pieces to choose num_shape_candidates
+returns a dict of candidate count to (recall, best edge recall, number of pairs compared)
+'''
+def reportShapeCandidateRecall(pieces, candidate_counts, weights=[3, 2, 1, 3], num_neighbors=10, num_workers=1):
+    for i, piece in enumerate(pieces):
+        piece.number = i
+    edge_scores = getEdgeScores(pieces, num_workers=num_workers)
+    dists = EdgeDists(edge_scores.num_edges, fill_value=float('inf'))
+    dists.setDists(edge_scores.raw_metrics['edge1'], edge_scores.raw_metrics['edge2'], edge_scores.getWeightedDists(weights))
+    edge_matrix = EdgeMatrix(pieces)
+    neighbor_index = NeighborIndex.fromDists(dists.dists, np.where(edge_matrix.flat, 0, num_neighbors))
+
+    print(f'\n\nshape candidate recall, {num_neighbors} closest edges, {len(edge_scores.raw_metrics)} valid pairs\n')
+    report = {}
+    for num_candidates in candidate_counts:
+        edges1, edges2 = edge_matrix.getShapeCandidates(num_candidates)
+        recall, best_recall = getCandidateRecall(neighbor_index, edges1, edges2)
+        report[num_candidates] = (recall, best_recall, len(edges1))
+        print(f'{num_candidates} candidates: recall {recall:.3f}, best edge recall {best_recall:.3f}, {len(edges1)} pairs compared')
+    return report
+
+# returns an EdgeDists matrix containing the distances between all edges
+# dists_path - if set, the matrix is stored in this memory mapped .npy file instead of in memory.
+#              Not used if only the shape candidates were compared, their dists are a SparseEdgeDists
+# memo_size - how many dists that aren't stored to remember once they are found as the solver goes
+def getDistDict(pieces, weight_dist=100, weight_color=100, weight_color_hist=100, weight_length_diff=100, num_edges_to_include=50, store_all_dists=True, edge_scores=None, num_workers=1, side_num_edges_to_include=None,
+        dists_path=None, dists_dtype=np.float32, memo_size=0):
+
+    if edge_scores is None:
+        edge_scores = getEdgeScores(pieces, num_workers=num_workers)
+    raw_metrics = edge_scores.raw_metrics
+
+    min_dist_diff, min_color_diff, min_color_diff_hist, min_corner_diff = edge_scores.mins
+    max_dist_diff, max_color_diff, max_color_diff_hist, max_corner_diff = edge_scores.maxs
 
     print(max_dist_diff, min_dist_diff, max_color_diff, min_color_diff,
           max_color_diff_hist, min_color_diff_hist, max_corner_diff, min_corner_diff)
@@ -647,44 +759,135 @@ def getDistDict(pieces, weight_dist=100, weight_color=100, weight_color_hist=100
 
     num_edges = 4*num_middle_pieces + 3*num_side_pieces + 2*4
 
-    sorted_dists = {}
-    side_num_edges_to_include = num_edges_to_include
+    num_to_include = getNumToInclude(pieces, num_edges_to_include, side_num_edges_to_include)
+
+    print('\n\nnormalizing ... \n')
+    weights = [weight_dist, weight_color, weight_color_hist, weight_length_diff]
+
+    # every valid pair is stored, so any pair not in the matrix can't be matched. If only the
+    # shape candidates were compared, just those pairs are stored and the rest are compared as
+    # the solver goes
+    sparse = not edge_scores.complete
+    all_dists_path = dists_path
+    if not store_all_dists and not dists_path is None:
+        all_dists_path = dists_path + '.all.npy'
+    if sparse:
+        dist_dict = SparseEdgeDists(edge_scores.num_edges, dtype=dists_dtype)
+    else:
+        dist_dict = EdgeDists(edge_scores.num_edges, fill_value=float('inf'), path=all_dists_path, dtype=dists_dtype)
+    # weight the pairs in chunks, so the raw metrics can be read from a file
+    max_dist = 0
+    chunk_size = 1 << 20
+    for start in range(0, len(raw_metrics), chunk_size):
+        dists = edge_scores.getWeightedDists(weights, start, start + chunk_size)
+        max_dist = max(max_dist, float(np.max(dists)))
+        dist_dict.setDists(raw_metrics['edge1'][start:start + chunk_size], raw_metrics['edge2'][start:start + chunk_size], dists)
+    dists = None
+
+    # closest edges to each edge, sorted_dists[edge id] is an array of edge ids
+    sorted_dists = NeighborIndex.fromDists(dist_dict if sparse else dist_dict.dists, num_to_include)
+
+    if not store_all_dists:
+        # only store the closest edges, the rest are compared as the solver goes
+        all_dists = dist_dict
+        if sparse:
+            dist_dict = SparseEdgeDists(edge_scores.num_edges, dtype=dists_dtype)
+        else:
+            dist_dict = EdgeDists(edge_scores.num_edges, path=dists_path, dtype=dists_dtype)
+        nearest_edges = np.repeat(np.arange(edge_scores.num_edges), np.diff(sorted_dists.indptr))
+        dist_dict.setDists(nearest_edges, sorted_dists.neighbors, all_dists.getPairDists(nearest_edges, sorted_dists.neighbors))
+        all_dists = None
+        if not sparse and not all_dists_path is None:
+            os.remove(all_dists_path)
+    dist_dict.flush()
+    if memo_size > 0:
+        dist_dict.memo = DistMemo(memo_size)
+    cutoff = float('inf')
+
+    setEdgeWeights(pieces, weights, edge_scores)
+    print(f'\n{max_dist}\n{len(dist_dict)}\n\n')
+
+    # make sure that if edge2 is close to edge1, edge1 is also in the list for edge2
+    sorted_dists.addReciprocalEdges(num_to_include)
 
+    buddy_edges = getBuddyEdges(pieces, dist_dict, sorted_dists, num_to_include)
+    return dist_dict, sorted_dists, buddy_edges, max_dist, cutoff
+
+'''
+updates the dists from getDistDict after pieces were added to the end of the list, the ones from
+first_new_piece on. Only the pairs with a new edge are compared, which are added to edge_scores and
+dist_dict, then sorted_dists is updated in place. If the new pairs change the min or max of a
+metric, the old pairs are weighted again, but still not compared again.
+dist_dict must hold every dist (store_all_dists=True), max_dist is the one returned with it
+returns the same as getDistDict
+'''
+def addToDistDict(pieces, first_new_piece, edge_scores, dist_dict, sorted_dists, max_dist, weights, num_edges_to_include=50,
+        side_num_edges_to_include=None, num_workers=1, num_shape_candidates=None):
+    print('\nnew dists\n')
+    first_new_edge = first_new_piece * 4
+    edge_matrix = EdgeMatrix(pieces)
+    candidates = None
+    if not edge_scores.complete and not num_shape_candidates is None:
+        candidates = edge_matrix.getShapeCandidates(num_shape_candidates)
+    raw_metrics, bounds = edge_matrix.getRawMetrics(progress=lambda rows: print(pieces[rows[0] // 4].label, end=' ', flush=True),
+            num_workers=num_workers, candidates=candidates, first_new_edge=first_new_edge)
+    bounds_changed = edge_scores.addRawMetrics(raw_metrics, edge_matrix.num_edges, bounds)
+
+    dist_dict.resize(edge_matrix.num_edges)
+    if bounds_changed:
+        # every dist changed, weight all of the pairs again
+        start = 0
+        max_dist = 0
+        dist_dict.num_stored = 0
+    else:
+        start = len(edge_scores.raw_metrics) - len(raw_metrics)
+    chunk_size = 1 << 20
+    for chunk_start in range(start, len(edge_scores.raw_metrics), chunk_size):
+        chunk = edge_scores.raw_metrics[chunk_start:chunk_start + chunk_size]
+        dists = edge_scores.getWeightedDists(weights, chunk_start, chunk_start + chunk_size)
+        max_dist = max(max_dist, float(np.max(dists)))
+        dist_dict.setDists(chunk['edge1'], chunk['edge2'], dists)
+    dists = None
+    dist_dict.flush()
+    if bounds_changed and not dist_dict.memo is None:
+        dist_dict.memo = DistMemo(dist_dict.memo.max_size)
+
+    num_to_include = getNumToInclude(pieces, num_edges_to_include, side_num_edges_to_include)
+    sparse = isinstance(dist_dict, SparseEdgeDists)
+    sorted_dists.update(dist_dict if sparse else dist_dict.dists, num_to_include, bounds_changed)
+    sorted_dists.addReciprocalEdges(num_to_include)
+
+    setEdgeWeights(pieces, weights, edge_scores)
+    buddy_edges = getBuddyEdges(pieces, dist_dict, sorted_dists, num_to_include)
+    return dist_dict, sorted_dists, buddy_edges, max_dist, float('inf')
 
+'''
+returns how many of the closest edges to keep for each edge id, none for flat edges
+'''
+def getNumToInclude(pieces, num_edges_to_include, side_num_edges_to_include=None):
+    if side_num_edges_to_include is None:
+        side_num_edges_to_include = num_edges_to_include
+    num_to_include = np.zeros(len(pieces) * 4, dtype=int)
     for piece1 in pieces:
         for edge1 in range(4):
             if piece1.edges[edge1].left_neighbor.label == 'flat' or piece1.edges[edge1].right_neighbor.label == 'flat':
-                sorted_dists[hash2(piece1, edge1)] = listOfKElements(side_num_edges_to_include)
+                num_to_include[hash2(piece1, edge1)] = side_num_edges_to_include
             elif piece1.edges[edge1].label != 'flat':
-                sorted_dists[hash2(piece1, edge1)] = listOfKElements(num_edges_to_include)
+                num_to_include[hash2(piece1, edge1)] = num_edges_to_include
+    return num_to_include
 
-    print('\n\nnormalizing ... \n')
-    max_dist = 0
-    for i, piece1 in enumerate(pieces):
-        print(piece1.label, end=' ', flush=True)
-        for edge1 in range(4):
-            for j, piece2 in enumerate(pieces[i+1:]):
-                for edge2 in range(4):
-                    entry = piece1.edges[edge1].compare(piece2.edges[edge2])
-                    if entry is None:
-                        continue
-                    dist_diff, color_diff, color_diff_hist, corner_diff = entry
-                    dist_diff = (dist_diff - min_dist_diff) / (max_dist_diff - min_dist_diff)
-                    color_diff = (color_diff - min_color_diff) / (max_color_diff - min_color_diff)
-                    color_diff_hist = (color_diff_hist - min_color_diff_hist) / (max_color_diff_hist - min_color_diff_hist)
-                    corner_diff = (corner_diff - min_corner_diff) / (max_corner_diff - min_corner_diff)
-
-                    dist = weight_dist*dist_diff + weight_color*color_diff + weight_color_hist*color_diff_hist + weight_length_diff*corner_diff
-                    if store_all_dists:
-                        dist_dict[(piece1, edge1, piece2, edge2)] = dist
-                    if dist < float('inf'):
-                        if dist > max_dist:
-                            max_dist = dist
-                        sorted_dists[hash2(piece1, edge1)].add(hash2(piece2, edge2), dist)
-                        sorted_dists[hash2(piece2, edge2)].add(hash2(piece1, edge1), dist)
-            # gc.collect()
-    cutoff = float('inf')
+'''
+sets the weights and bounds used by Edge.compareWeighted for pairs that aren't stored
+'''
+def setEdgeWeights(pieces, weights, edge_scores):
+    edges = [edge for piece in pieces for edge in piece.edges]
+    for table, positions in groupByTable(edges).items():
+        table.setWeights([edges[k].index for k in positions], weights, edge_scores.mins, edge_scores.maxs)
 
+'''
+returns the pairs of edges that are each other's closest edge, sorted by dist
+'''
+def getBuddyEdges(pieces, dist_dict, sorted_dists, num_to_include):
     best_edges = {}
     max_num_edges_to_check = 1
 
@@ -692,42 +895,13 @@ def getDistDict(pieces, weight_dist=100, weight_color=100, weight_color_hist=100
     for piece1 in pieces:
         print(piece1.label, end=' ', flush=True)
         for edge1 in range(4):
-            piece1.edges[edge1].weights = [weight_dist, weight_color, weight_color_hist, weight_length_diff]
-            piece1.edges[edge1].mins = [min_dist_diff, min_color_diff, min_color_diff_hist, min_corner_diff]
-            piece1.edges[edge1].maxs = [max_dist_diff, max_color_diff, max_color_diff_hist, max_corner_diff]
-            entry = sorted_dists.get(hash2(piece1, edge1))
-            if entry is None:
-                continue
-            values = entry.getValues()
-            if not store_all_dists:
-                dists = entry.getDists()
-                for i, dist in enumerate(dists):
-                    value = values[i]
-                    dist_dict[(piece1, edge1, pieces[value//4], value%4)] = dist
-            sorted_dists[hash2(piece1, edge1)] = values
-            best_edges[(piece1, edge1)] = sorted_dists[hash2(piece1, edge1)][:max_num_edges_to_check]
-    
-    print(f'\n{max_dist}\n{len(dist_dict.keys())}\n\n')
-
-    for piece1 in pieces:
-        for edge1 in range(4):
-            values = sorted_dists.get(hash2(piece1, edge1))
-            if values is None:
+            edge_index = hash2(piece1, edge1)
+            if num_to_include[edge_index] == 0:
                 continue
-            for edge_index in values:
-                piece2 = pieces[edge_index // 4]
-                edge2 = edge_index % 4
-                if sorted_dists.get(hash2(piece2, edge2)) is None:
-                    continue
-                if not hash2(piece1, edge1) in sorted_dists[hash2(piece2, edge2)]:
-                    sorted_dists[hash2(piece2, edge2)].append(hash2(piece1, edge1))
+            # just the closest edges, not ones added by addReciprocalEdges
+            num_closest = min(max_num_edges_to_check, sorted_dists.num_closest[edge_index])
+            best_edges[(piece1, edge1)] = sorted_dists[edge_index][:num_closest].tolist()
 
-    for piece1 in pieces:
-        for edge1 in range(4):
-            sorted_list = sorted_dists.get(hash2(piece1, edge1))
-            if sorted_list is None:
-                continue
-            sorted_dists[(piece1, edge1)] = sorted(sorted_list, key=lambda x:getDist(dist_dict, (piece1, edge1, pieces[x//4], x%4)))
     print('\n\nfinding best buddies\n')
     buddy_edges_set = set()
     prev_piece = None
@@ -745,14 +919,14 @@ def getDistDict(pieces, weight_dist=100, weight_color=100, weight_color_hist=100
             piece2 = pieces[edge_index // 4]
             edge2 = edge_index % 4
             if best_edges[(piece2, edge2)][0] == p1_index:
-                buddy_edges_set.add(((piece1, edge1, piece2, edge2), dist))
+                buddy_edges_set.add(((piece1, edge1, piece2, edge2), getDist(dist_dict, (piece1, edge1, piece2, edge2))))
                 break
     buddy_edges_list = sorted([buddy for buddy in buddy_edges_set], key=lambda x:x[1])
     buddy_edges = [buddy[0] for buddy in buddy_edges_list]
     best_edges = None
     gc.collect()
     print(f'\n\n\nnum best buddies::: {len(buddy_edges)}\n\n')
-    return dist_dict, sorted_dists, buddy_edges, max_dist, cutoff
+    return buddy_edges
 
 def hash2(piece1, edge1):
     return piece1.number * 4 + edge1
@@ -760,58 +934,21 @@ def hash2(piece1, edge1):
 def getDist(dist_dict, edge):
     if edge[0] == edge[2]:
         return float('inf')
-    res = dist_dict.get(edge) if dist_dict.get(edge) else dist_dict.get((edge[2], edge[3], edge[0], edge[1]))
+    res = dist_dict.getDist(hash2(edge[0], edge[1]), hash2(edge[2], edge[3]))
     if res is None:
         return float('inf')
     return res
 
-class listOfKElements():
-
-    def __init__(self, k):
-        self.k = k
-        self.value_list = []
-        self.dist_list = []
-        self.max_dist = float('-inf')
-        self.max_dist_pos = 0
-
-    def addNoBlock(self, value, dist):
-        if dist > self.max_dist:
-            self.max_dist = dist
-            self.max_dist_pos = len(self.value_list)
-        self.value_list.append(value)
-        self.dist_list.append(dist)
-
-    def add(self, value, dist):
-        if len(self.value_list) < self.k:
-            self.addNoBlock(value, dist)
-            return
-        if dist < self.max_dist:
-            self.max_dist = dist
-            self.value_list[self.max_dist_pos] = value
-            self.dist_list[self.max_dist_pos] = dist
-            new_max = float('-inf')
-            new_max_pos = 0
-            for i, dist in enumerate(self.dist_list):
-                if dist > new_max:
-                    new_max = dist
-                    new_max_pos = i
-            self.max_dist = new_max
-            self.max_dist_pos = new_max_pos
-
-    def getValues(self):
-        order = sorted(range(len(self.dist_list)), key=lambda x:self.dist_list[x])
-        sorted_values = [self.value_list[i] for i in order]
-        return sorted_values
-
-    def getDists(self):
-        return sorted(self.dist_list)
-
-def toJSON(puzzle_name, dims, num_gens, gen_size, image_infos, show_sols=True, settings=[10, 50, 50, 20, 30, 64], color_spec="HSV", sides_first=False):
+def toJSON(puzzle_name, dims, num_gens, gen_size, image_infos, show_sols=True, settings=[10, 50, 50, 20, 30, 64], color_spec="HSV", sides_first=False, num_workers=1, num_shape_candidates=None,
+        dists_dir=None, dists_dtype='float32', memo_size=100000, segment_scale=1, prefetch_depth=2):
     import json
     json_dict = {"puzzle_name":puzzle_name, "dims":list(dims), "num_gens":num_gens,
                 "gen_size":gen_size, 
                 "file_info":[{"path":entry[0], "num_pieces":entry[1]} for entry in image_infos],
-                "show_sols":False, "settings":settings, "color_spec":color_spec, "sides_first":sides_first}
+                "show_sols":False, "settings":settings, "color_spec":color_spec, "sides_first":sides_first,
+                "num_workers":num_workers, "num_shape_candidates":num_shape_candidates,
+                "dists_dir":dists_dir, "dists_dtype":dists_dtype, "memo_size":memo_size,
+                "segment_scale":segment_scale, "prefetch_depth":prefetch_depth}
 
     with open(f'input/{puzzle_name}.JSON', 'w') as f:
         json.dump(json_dict, f)
@@ -38,7 +38,13 @@ def runSolverJSON(path):
                      for entry in puzzle_data["file_info"]]
         solver = PuzzleSolver(puzzle_data["puzzle_name"], tuple(puzzle_data["dims"]), puzzle_data["num_gens"],
                               puzzle_data["gen_size"], file_list, settings=puzzle_data["settings"],
-                              color_spec=puzzle_data["color_spec"], show_sols=False)
+                              color_spec=puzzle_data["color_spec"], show_sols=False,
+                              num_workers=puzzle_data.get("num_workers", 1),
+                              num_shape_candidates=puzzle_data.get("num_shape_candidates"),
+                              dists_dir=puzzle_data.get("dists_dir"), dists_dtype=puzzle_data.get("dists_dtype", "float32"),
+                              memo_size=puzzle_data.get("memo_size", 100000),
+                              segment_scale=puzzle_data.get("segment_scale", 1),
+                              prefetch_depth=puzzle_data.get("prefetch_depth", 2))
     solver.solvePuzzle_gui_mode()
 
 